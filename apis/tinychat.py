@@ -1,7 +1,160 @@
 """ Contains functions to fetch info from tinychat's API. """
+import collections
+import logging
+import threading
 import time
 
 import util.web
+from util import disk_cache
+
+log = logging.getLogger(__name__)
+
+# Seconds to keep a response in the cache. The cache is shared by all clients in the process.
+CACHE_TTL = 300
+# Room user lists change often, so spy info is kept for a shorter time.
+SPY_INFO_TTL = 30
+# Seconds to keep an error response (or a failed request), so it is not retried on every join.
+NEGATIVE_TTL = 30
+# The most responses in the cache, the least recently used are removed first.
+CACHE_SIZE = 5000
+
+# (expires, value) keyed by (api, argument), least recently used first.
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+# threading.Event keyed by cache key, for the requests being made.
+_in_flight = {}
+_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'store_hits': 0}
+# util.disk_cache.DiskCache keeping the responses across restarts, see open_store.
+_store = None
+_store_lock = threading.Lock()
+
+
+def open_store(path, compact_interval=3600):
+    """
+    Keep the responses in a database file as well, so they are shared by the
+    processes using the same file and survive restarts. Does nothing if a
+    store is open already.
+    :param path: str the path to the database file.
+    :param compact_interval: int seconds between removing expired responses from the file.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = disk_cache.DiskCache(path)
+            except Exception as e:
+                log.error('failed to open the api cache database %s: %s' % (path, e))
+                return
+            _store.start_compaction(compact_interval)
+
+
+def close_store():
+    """ Stop using the database file. """
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.stop_compaction()
+            _store = None
+
+
+def _cached(key):
+    """
+    Get a value from the cache. Must be called with the cache lock held.
+    :param key: tuple the cache key.
+    :return: tuple (True, value) if the key is cached and not expired, else (False, None).
+    """
+    entry = _cache.pop(key, None)
+    if entry is not None and entry[0] > time.time():
+        # most recently used.
+        _cache[key] = entry
+        return True, entry[1]
+    return False, None
+
+
+def _cache_set(key, value, ttl):
+    """ Cache a value. Must be called with the cache lock held. """
+    _cache.pop(key, None)
+    _cache[key] = (time.time() + ttl, value)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+        _stats['evictions'] += 1
+
+
+def _is_error(value):
+    return value is None or 'error' in value
+
+
+def _cached_request(key, request, ttl):
+    """
+    Get a response from the cache, or make the request and cache the response.
+
+    Error responses are cached for NEGATIVE_TTL seconds. If the same request
+    is already being made by another thread, wait for its response instead
+    of making it again. If a store is open (see open_store) it is checked
+    before making the request, and the response is stored.
+
+    :param key: tuple the cache key.
+    :param request: function making the request, returning the response.
+    :param ttl: int seconds to cache the response.
+    :return: the response.
+    """
+    while True:
+        with _cache_lock:
+            is_cached, value = _cached(key)
+            if is_cached:
+                _stats['hits'] += 1
+                return value
+            event = _in_flight.get(key)
+            if event is None:
+                _stats['misses'] += 1
+                event = _in_flight[key] = threading.Event()
+                break
+            _stats['coalesced'] += 1
+        # the response is cached when the event is set, unless the request raised,
+        # in which case one of the waiting threads makes it again.
+        event.wait()
+
+    try:
+        store = _store
+        if store is not None:
+            store_key = '%s:%s' % key
+            is_stored, value, expires = store.get(store_key)
+            if is_stored:
+                with _cache_lock:
+                    _stats['store_hits'] += 1
+                    _cache_set(key, value, expires - time.time())
+                return value
+
+        value = request()
+        ttl = NEGATIVE_TTL if _is_error(value) else ttl
+        with _cache_lock:
+            _cache_set(key, value, ttl)
+        if store is not None:
+            store.set(store_key, value, ttl)
+        return value
+    finally:
+        with _cache_lock:
+            del _in_flight[key]
+        event.set()
+
+
+def cache_stats():
+    """
+    The cache counters. Misses found in the store count as store_hits.
+    :return: dict {'size', 'hits', 'misses', 'coalesced', 'evictions', 'store_hits'}
+    """
+    with _cache_lock:
+        stats = dict(_stats)
+        stats['size'] = len(_cache)
+    return stats
+
+
+def clear_cache():
+    """ Remove all cached responses, from the store as well. """
+    with _cache_lock:
+        _cache.clear()
+    if _store is not None:
+        _store.clear()
 
 
 def user_info(tc_account):
@@ -10,6 +163,11 @@ def user_info(tc_account):
     :param tc_account: str the account name.
     :return: dict {'username', 'tinychat_id', 'last_active', 'name', 'location', 'biography'} or None on error.
     """
+    return _cached_request(('user_info', tc_account), lambda: _user_info(tc_account), CACHE_TTL)
+
+
+def _user_info(tc_account):
+    """ Request the info of a tinychat account, see user_info. """
     url = 'https://tinychat.com/api/tcinfo?username=%s' % tc_account
     response = util.web.http_get(url=url, json=True)
     if response['json'] is not None:
@@ -42,6 +200,11 @@ def spy_info(room):
     :param room: str the room name to get spy info for.
     :return: dict{'mod_count', 'broadcaster_count', 'total_count', list('users')} or {'error'}.
     """
+    return _cached_request(('spy_info', room), lambda: _spy_info(room), SPY_INFO_TTL)
+
+
+def _spy_info(room):
+    """ Request the spy info of a room, see spy_info. """
     url = 'https://api.tinychat.com/%s.json' % room
     response = util.web.http_get(url, json=True)
     if response['json'] is not None:
@@ -0,0 +1,62 @@
+"""
+Decode rate of pyamf's amf0.Decoder and rtmplib.fast_amf0.Decoder
+on joins and privmsg command bodies.
+
+Run from the repository root:
+
+    python bench/bench_amf0.py [seconds per run]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pyamf
+import pyamf.util
+from pyamf import amf0
+
+from rtmplib import fast_amf0, reader
+
+
+def encode(elements):
+    stream = pyamf.util.BufferedByteStream()
+    encoder = amf0.Encoder(stream)
+    for element in elements:
+        encoder.writeElement(element)
+    return stream.getvalue()
+
+
+def decode(data, decoder_class):
+    stream = reader.BodyStream(memoryview(bytearray(data)))
+    decoder = decoder_class(stream)
+    while not stream.at_eof():
+        decoder.readElement()
+
+
+def rate(data, decoder_class, seconds):
+    """ Messages decoded per second. """
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        decode(data, decoder_class)
+        count += 1
+    return count / (time.time() - start)
+
+
+def main(seconds=2.0):
+    users = [pyamf.ASObject({'nick': u'user%d' % i, 'id': i, 'account': u'', 'own': False, 'mod': False,
+                             'lf': False, 'gp': 0, 'bf': False, 'btype': u'', 'stype': 0, 'alevel': u''})
+             for i in range(10)]
+    payloads = [
+        ('joins', encode([u'joins', 0, None] + users)),
+        ('privmsg', encode([u'privmsg', 0, None, u','.join([u'104'] * 60), u'#262626,en', u'someone']))
+    ]
+    for name, data in payloads:
+        slow = rate(data, amf0.Decoder, seconds)
+        fast = rate(data, fast_amf0.Decoder, seconds)
+        print('%-8s pyamf %8d msg/s  fast_amf0 %8d msg/s  x%.2f' % (name, slow, fast, fast / slow))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:]])
@@ -27,6 +27,40 @@ RESET_INIT_TIME = False
 RECONNECT_DELAY = 60
 # Auto job interval in seconds.
 AUTO_JOB_INTERVAL = 300
+# The chunk size to send messages with, None to use the default (128)
+CHUNK_SIZE = 4096
+# Pace outbound messages, control first, then moderation, then chat.
+ENABLE_SEND_QUEUE = True
+# Moderation (kick, forgive, owner_run) and chat messages per second, 0 for no limit.
+MODERATION_SEND_RATE = 5
+CHAT_SEND_RATE = 2
+# The most messages of a lane sent at once before the rate applies.
+SEND_BURST = 5
+# The most messages waiting to be sent in a lane, further messages are dropped.
+SEND_QUEUE_SIZE = 100
+# The number of threads handling user joins, per client (or per room manager).
+JOIN_WORKERS = 4
+# The joins waiting for a join thread above which a warning is logged, the joins are still handled.
+JOIN_QUEUE_SIZE = 100
+# The number of worker threads of a room manager.
+MANAGER_WORKERS = 8
+# The most connections the shared web session keeps per host.
+HTTP_POOL_SIZE = 20
+# The number of worker processes of the supervisor, None for one per cpu.
+SUPERVISOR_PROCESSES = None
+# The file listing the rooms for the supervisor, a room name (and optionally a nick) per line.
+SUPERVISOR_ROOM_FILE = 'rooms.txt'
+# Seconds between the health reports of the supervisor's worker processes.
+SUPERVISOR_HEALTH_INTERVAL = 10
+# Seconds between moving rooms from busy to idle worker processes.
+SUPERVISOR_REBALANCE_INTERVAL = 300
+# The most seconds to wait before restarting a crashed worker process.
+SUPERVISOR_MAX_RESTART_DELAY = 300
+# Keep tinychat api responses in this database file in the config folder, shared
+# by all processes and kept across restarts. Empty to only cache in memory.
+API_CACHE_FILE = 'api_cache.db'
+# Seconds between removing expired responses from the database file.
+API_CACHE_COMPACT_INTERVAL = 3600
 # The name of pinylib's debug log file.
 DEBUG_FILE_NAME = 'pinylib_debug.log'
 # The path to the config folder.
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """ Pinylib module by Nortxort. https://github.com/nortxort/pinylib """
 
+import collections
+import functools
 import logging
 import threading
 import time
@@ -11,9 +13,9 @@ from colorama import init, Fore, Style
 import config
 import user
 import apis.tinychat
-from rtmplib import rtmp
+from rtmplib import rtmp, sendqueue
 from page import acc, params
-from util import string_util, file_handler
+from util import string_util, file_handler, pool
 
 __version__ = '7.0.1'
 
@@ -36,6 +38,161 @@ CONFIG = config
 init(autoreset=True)
 log = logging.getLogger(__name__)
 
+#  Pre-encoded privmsg command, used for all chat, private and undercover messages.
+PRIVMSG_TEMPLATE = rtmp.writer.CommandTemplate('privmsg')
+
+
+def send_rates():
+    """ The (rate, burst) of the send queue lanes, control, moderation and chat.
+
+    :return: The rates, or None if outbound messages are not paced.
+    :rtype: list | None
+    """
+    if not config.ENABLE_SEND_QUEUE:
+        return None
+    return [(0, 1),
+            (config.MODERATION_SEND_RATE, config.SEND_BURST),
+            (config.CHAT_SEND_RATE, config.SEND_BURST)]
+
+
+#  How the arguments of a command are passed to its handler, see CommandSpec.
+SPREAD = 0
+LIST = 1
+EACH = 2
+PAIRS = 3
+
+
+class CommandSpec(object):
+    """ How to dispatch a command received from the RTMP application. """
+    __slots__ = ('name', 'handler', 'start', 'stop', 'expand', 'coerce', 'order', 'run_async', 'greenroom')
+
+    def __init__(self, name, handler, start=3, stop=None, expand=SPREAD, coerce=None, order=None,
+                 run_async=False, greenroom=False):
+        """ Create a command spec.
+
+        :param name: The command name.
+        :type name: str
+        :param handler: The name of the client method handling the command, a function
+        taking the client and the arguments, or None to ignore the command.
+        :type handler: str | callable | None
+        :param start: The index of the first argument in the command.
+        :type start: int
+        :param stop: The index after the last argument, None for all following arguments.
+        :type stop: int | None
+        :param expand: SPREAD calls the handler with the arguments, LIST with the arguments as a list,
+        EACH once for every argument and PAIRS once for every two arguments.
+        :type expand: int
+        :param coerce: A function (or None) per argument, converting the argument.
+        :type coerce: tuple | None
+        :param order: The order of the (coerced) arguments in the handler call, by index.
+        :type order: tuple | None
+        :param run_async: Call the handler on a worker, for handlers that block.
+        :type run_async: bool
+        :param greenroom: Dispatch the command from the greenroom as well,
+        the handler is then called with greenroom=True
+        :type greenroom: bool
+        """
+        self.name = name
+        self.handler = handler
+        self.start = start
+        self.stop = stop
+        self.expand = expand
+        self.coerce = coerce
+        self.order = order
+        self.run_async = run_async
+        self.greenroom = greenroom
+
+    def unpack(self, amf0_cmd):
+        """ The arguments of the handler calls for a command.
+
+        :param amf0_cmd: The command.
+        :type amf0_cmd: list
+        :return: A list of argument lists, one for each handler call.
+        :rtype: list
+        """
+        values = amf0_cmd[self.start:self.stop]
+        if self.expand == LIST:
+            return [[values]]
+        if self.expand == EACH:
+            groups = [[value] for value in values]
+        elif self.expand == PAIRS:
+            groups = [values[i:i + 2] for i in range(0, len(values) - 1, 2)]
+        else:
+            groups = [values]
+
+        if self.coerce is not None or self.order is not None:
+            for i, group in enumerate(groups):
+                if self.coerce is not None:
+                    group = [f(v) if f is not None else v for f, v in zip(self.coerce, group)] + \
+                            group[len(self.coerce):]
+                if self.order is not None:
+                    group = [group[j] for j in self.order]
+                groups[i] = group
+        return groups
+
+
+def open_api_store():
+    """ Keep the tinychat api responses in config.API_CACHE_FILE as well, see apis.tinychat.open_store.
+
+    Call it once per process, before the clients are connected.
+    """
+    if config.API_CACHE_FILE:
+        apis.tinychat.open_store(config.CONFIG_PATH + config.API_CACHE_FILE, config.API_CACHE_COMPACT_INTERVAL)
+
+
+def _str_int(value):
+    return str(int(value))
+
+
+#  The commands dispatched by all clients, keyed by command name.
+COMMANDS = {}
+
+
+def register_command(name, handler, **kwargs):
+    """ Register (or override) how all clients dispatch a command.
+
+    Clients created after this use the command, see
+    TinychatRTMPClient.register_command to change a single client.
+
+    :param name: The command name.
+    :type name: str
+    :param handler: See CommandSpec.
+    :param kwargs: See CommandSpec.
+    :return: The command spec.
+    :rtype: CommandSpec
+    """
+    spec = CommandSpec(name, handler, **kwargs)
+    COMMANDS[name] = spec
+    return spec
+
+
+register_command('_result', 'on_result', start=0, expand=LIST, greenroom=True)
+register_command('_error', 'on_error', start=0, expand=LIST, greenroom=True)
+register_command('onBWDone', 'on_bwdone', stop=3)
+register_command('onStatus', 'on_status', start=0, expand=LIST)
+register_command('registered', 'on_registered', stop=4)
+# on_join looks the user up with the tinychat api, so it runs on a join worker.
+register_command('join', '_on_join_cmd', stop=4)
+register_command('joins', 'on_joins', expand=EACH)
+register_command('joinsdone', 'on_joinsdone', stop=3)
+register_command('oper', '_on_oper_cmd', expand=PAIRS, coerce=(_str_int,))
+register_command('deop', 'on_deop', stop=5)
+register_command('avons', 'on_avon', start=4, expand=PAIRS)
+register_command('pros', 'on_pro', start=4, expand=EACH, coerce=(_str_int,))
+register_command('nick', 'on_nick', stop=6, coerce=(None, None, int))
+register_command('nickinuse', 'on_nickinuse', stop=3)
+register_command('quit', 'on_quit', stop=5, order=(1, 0))
+register_command('kick', 'on_kick', stop=5)
+register_command('banned', 'on_banned', stop=3)
+register_command('banlist', 'on_banlist', expand=PAIRS)
+register_command('startbanlist', None)
+register_command('topic', 'on_topic', stop=4)
+register_command('from_owner', 'on_from_owner', stop=4)
+register_command('doublesignon', 'on_doublesignon', stop=3)
+register_command('privmsg', 'on_privmsg', start=4, stop=7, order=(2, 0, 1))
+register_command('notice', '_on_notice_cmd', stop=6, greenroom=True)
+register_command('gift', 'on_gift', stop=6, order=(1, 0, 2))
+
 
 def write_to_log(msg, room_name):
     """ Writes chat events to log.
@@ -93,6 +250,17 @@ class TinychatRTMPClient(object):
         self._is_reconnected = False
         self._reconnect_delay = config.RECONNECT_DELAY
         self._init_time = time.time()
+        # room_manager.RoomManager hosting the client, or None when the client runs on its own threads.
+        self.manager = None
+        self._auto_job = None
+        self._is_closed = False
+        # CommandSpec keyed by command name, see register_command.
+        self.commands = dict(COMMANDS)
+        # the number of times each registered command was received, other commands are counted as 'unknown'.
+        self.command_counts = collections.Counter()
+        self.green_command_counts = collections.Counter()
+        # runs on_join, when the client is not hosted by a room manager.
+        self._join_pool = pool.StripedPool(config.JOIN_WORKERS, config.JOIN_QUEUE_SIZE, name='join')
 
     def console_write(self, color, message):
         """ Writes message to console.
@@ -159,7 +327,12 @@ class TinychatRTMPClient(object):
                     page_url=self.param.embed_url,
                     swf_url=self.param.swf_url,
                     proxy=self._proxy,
-                    is_win=True
+                    is_win=True,
+                    fast_amf0=True,
+                    chunk_size=config.CHUNK_SIZE,
+                    send_rates=send_rates(),
+                    send_queue_size=config.SEND_QUEUE_SIZE,
+                    call_later=self._call_later
                 )
                 self.connection.connect(
                     {
@@ -182,8 +355,11 @@ class TinychatRTMPClient(object):
                 if config.RESET_INIT_TIME:
                     self._init_time = time.time()
                 if self.param.is_greenroom and not self.is_green_connected:
-                    threading.Thread(target=self.__connect_green).start()
-                self.__callback()
+                    self._run_async(self.__connect_green)
+                if self.manager is None:
+                    self.__callback()
+                elif self.is_connected:
+                    self.manager.hub.add(self.connection, self._on_hub_message, self._on_hub_close)
 
     def __connect_green(self):
         """ Make a connection to the greenroom application. """
@@ -197,7 +373,12 @@ class TinychatRTMPClient(object):
                     page_url=self.param.embed_url,
                     swf_url=self.param.swf_url,
                     proxy=self._proxy,
-                    is_win=True
+                    is_win=True,
+                    fast_amf0=True,
+                    chunk_size=config.CHUNK_SIZE,
+                    send_rates=send_rates(),
+                    send_queue_size=config.SEND_QUEUE_SIZE,
+                    call_later=self._call_later
                 )
                 self.green_connection.connect(
                     {
@@ -217,7 +398,10 @@ class TinychatRTMPClient(object):
                 if config.DEBUG_MODE:
                     traceback.print_exc()
             finally:
-                self.__green_callback()
+                if self.manager is None:
+                    self.__green_callback()
+                elif self.is_green_connected:
+                    self.manager.hub.add(self.green_connection, self._on_hub_message, self._on_hub_close)
 
     def disconnect(self, greenroom=False):
         """ Close the connection with the remote RTMP server.
@@ -231,11 +415,15 @@ class TinychatRTMPClient(object):
             if greenroom:
                 log.info('disconnection from greenroom application')
                 self.is_green_connected = False
+                if self.manager is not None:
+                    self.manager.hub.remove(self.green_connection)
                 self.green_connection.shutdown()
             else:
                 self.is_connected = False
                 self._bauth_key = None
                 self.users.clear()
+                if self.manager is not None:
+                    self.manager.hub.remove(self.connection)
                 self.connection.shutdown()
         except Exception as e:
             log.error('disconnect error, greenroom: %s, error: %s' % (greenroom, e), exc_info=True)
@@ -249,9 +437,14 @@ class TinychatRTMPClient(object):
         reconnect to the normal application(room)
         :type greenroom: bool
         """
+        if self._is_closed:
+            return
         if greenroom:
             log.info('reconnecting to the greenroom application.')
             self.disconnect(greenroom=True)
+            if self.manager is not None:
+                self._call_later(config.RECONNECT_DELAY, self.__connect_green)
+                return
             time.sleep(config.RECONNECT_DELAY)
             self.__connect_green()
         else:
@@ -260,13 +453,22 @@ class TinychatRTMPClient(object):
             self.console_write(COLOR['bright_cyan'], reconnect_msg)
             self._is_reconnected = True
             self.disconnect()
-            time.sleep(self._reconnect_delay)
+            reconnect_delay = self._reconnect_delay
 
             # increase reconnect_delay after each reconnect.
             self._reconnect_delay *= 2
             if self._reconnect_delay > 900:
                 self._reconnect_delay = config.RECONNECT_DELAY
 
+            if self.manager is not None:
+                self._call_later(reconnect_delay, self._reconnect_room)
+            else:
+                time.sleep(reconnect_delay)
+                self._reconnect_room()
+
+    def _reconnect_room(self):
+        """ Login (if using an account), set the rtmp parameters and connect. """
+        if not self._is_closed:
             if self.account and self.password:
                 if not self.login():
                     self.console_write(COLOR['bright_red'], 'Failed to login.')
@@ -281,16 +483,59 @@ class TinychatRTMPClient(object):
                 if config.DEBUG_MODE:
                     self.console_write(COLOR['bright_red'], msg)
 
+    def close(self):
+        """ Disconnect for good, the client will not reconnect or run the auto job again. """
+        self._is_closed = True
+        if self._auto_job is not None:
+            self._auto_job.cancel()
+            self._auto_job = None
+        self._join_pool.stop()
+        if self.is_green_connected:
+            self.disconnect(greenroom=True)
+        if self.is_connected:
+            self.disconnect()
+
+    def _run_async(self, target, *args):
+        """ Run target on a worker of the room manager, or on a new thread. """
+        if self.manager is not None:
+            self.manager.pool.submit(target, *args)
+        else:
+            threading.Thread(target=target, args=args).start()
+
+    def _call_later(self, delay, target, *args):
+        """ Run target after delay seconds, on a worker of the room manager, or on a timer thread.
+
+        :return: A job/timer with a cancel method.
+        """
+        if self.manager is not None:
+            return self.manager.scheduler.call_later(delay, self.manager.pool.submit, target, *args)
+        timer = threading.Timer(delay, target, args)
+        timer.start()
+        return timer
+
+    def _on_hub_message(self, connection, amf0_data):
+        """ Called by the room manager's connection hub for every message received. """
+        if connection is self.connection:
+            self._handle_amf(amf0_data)
+        elif connection is self.green_connection:
+            self._handle_green_amf(amf0_data)
+
+    def _on_hub_close(self, connection, error):
+        """ Called by the room manager's connection hub when a connection is lost. """
+        if connection is self.connection and self.is_connected:
+            log.error('connection lost: %s' % error)
+            self._run_async(self.reconnect)
+        elif connection is self.green_connection and self.is_green_connected:
+            log.error('greenroom connection lost: %s' % error)
+            self._run_async(self.reconnect, True)
+
     def __green_callback(self):
         """ Read packets from the greenroom RTMP application. """
         log.info('starting greenroom callback loop. is_green_connected: %s' % self.is_green_connected)
         fails = 0
-        amf0_data_type = - 1
-        amf0_data = None
         while self.is_green_connected:
             try:
                 amf0_data = self.green_connection.amf()
-                amf0_data_type = amf0_data['msg']
             except rtmp.AmfDataReadError as e:
                 fails += 1
                 log.error('greenroom amf read error: %s %s' % (fails, e), exc_info=True)
@@ -299,46 +544,35 @@ class TinychatRTMPClient(object):
                         traceback.print_exc()
                     self.reconnect(greenroom=True)
                     break
+                continue
             else:
                 fails = 0
             try:
-                if amf0_data_type == rtmp.rtmp_type.DT_COMMAND:
-
-                    amf0_cmd = amf0_data['command']
-                    cmd = amf0_cmd[0]
-
-                    if cmd == '_result':
-                        self.on_result(amf0_cmd, greenroom=True)
-
-                    elif cmd == '_error':
-                        self.on_error(amf0_cmd, greenroom=True)
-
-                    elif cmd == 'notice':
-                        notice_msg = amf0_cmd[3]
-                        notice_msg_id = amf0_cmd[4]
-                        if notice_msg == 'avon':
-                            avon_name = amf0_cmd[5]
-                            self.on_avon(notice_msg_id, avon_name, greenroom=True)
-                    else:
-                        if config.DEBUG_MODE:
-                            self.console_write(COLOR['white'], 'ignoring greenroom command: %s' % cmd)
-
+                self._handle_green_amf(amf0_data)
             except Exception as gge:
                 log.error('general greenroom callback error: %s' % gge, exc_info=True)
                 if config.DEBUG_MODE:
                     traceback.print_exc()
                 self.reconnect(greenroom=True)
 
+    def _handle_green_amf(self, amf0_data):
+        """ Handle a message from the greenroom RTMP application.
+
+        :param amf0_data: The message.
+        :type amf0_data: dict
+        """
+        if amf0_data['msg'] == rtmp.rtmp_type.DT_COMMAND:
+            if not self.dispatch_command(amf0_data['command'], greenroom=True):
+                if config.DEBUG_MODE:
+                    self.console_write(COLOR['white'], 'ignoring greenroom command: %s' % amf0_data['command'][0])
+
     def __callback(self):
         """ Read packets from the RTMP application. """
         log.info('starting callback loop. is_connected: %s' % self.is_connected)
         fails = 0
-        amf0_data_type = -1
-        amf0_data = None
         while self.is_connected:
             try:
                 amf0_data = self.connection.amf()
-                amf0_data_type = amf0_data['msg']
             except rtmp.AmfDataReadError as e:
                 fails += 1
                 log.error('amf data read error count: %s %s' % (fails, e), exc_info=True)
@@ -347,162 +581,111 @@ class TinychatRTMPClient(object):
                         traceback.print_exc()
                     self.reconnect()
                     break
+                continue
             else:
                 fails = 0
             try:
-                if amf0_data_type == rtmp.rtmp_type.DT_COMMAND:
-
-                    create_stream_res = self.connection.is_create_stream_response(amf0_data)
-                    if create_stream_res:
-                        msg = 'create stream response, stream_id: %s' % self.connection.stream_id
-                        log.info(msg)
-                        self.connection.publish(self._client_id)
-                        if config.DEBUG_MODE:
-                            self.console_write(COLOR['white'], msg)
-                        continue
-
-                    amf0_cmd = amf0_data['command']
-                    cmd = amf0_cmd[0]
-                    iparam0 = 0
-
-                    if cmd == '_result':
-                        self.on_result(amf0_cmd)
-
-                    elif cmd == '_error':
-                        self.on_error(amf0_cmd)
-
-                    elif cmd == 'onBWDone':
-                        self.on_bwdone()
-
-                    elif cmd == 'onStatus':
-                        self.on_status(amf0_cmd)
-
-                    elif cmd == 'registered':
-                        client_info_dict = amf0_cmd[3]
-                        self.on_registered(client_info_dict)
-
-                    elif cmd == 'join':
-                        join_info = amf0_cmd[3]
-                        threading.Thread(target=self.on_join, args=(join_info,)).start()
-
-                    elif cmd == 'joins':
-                        current_room_users_info_list = amf0_cmd[3:]
-                        if len(current_room_users_info_list) is not 0:
-                            while iparam0 < len(current_room_users_info_list):
-                                self.on_joins(current_room_users_info_list[iparam0])
-                                iparam0 += 1
-
-                    elif cmd == 'joinsdone':
-                        self.on_joinsdone()
-
-                    elif cmd == 'oper':
-                        oper_id_name = amf0_cmd[3:]
-                        while iparam0 < len(oper_id_name):
-                            oper_id = str(int(oper_id_name[iparam0]))
-                            oper_name = oper_id_name[iparam0 + 1]
-                            if len(oper_id) == 1:
-                                self.on_oper(oper_id[0], oper_name)
-                            iparam0 += 2
-
-                    elif cmd == 'deop':
-                        deop_id = amf0_cmd[3]
-                        deop_nick = amf0_cmd[4]
-                        self.on_deop(deop_id, deop_nick)
-
-                    # elif cmd == 'owner':
-                    #     self.on_owner()
-
-                    elif cmd == 'avons':
-                        avons_id_name = amf0_cmd[4:]
-                        if len(avons_id_name) is not 0:
-                            while iparam0 < len(avons_id_name):
-                                avons_id = avons_id_name[iparam0]
-                                avons_name = avons_id_name[iparam0 + 1]
-                                self.on_avon(avons_id, avons_name)
-                                iparam0 += 2
-
-                    elif cmd == 'pros':
-                        pro_ids = amf0_cmd[4:]
-                        if len(pro_ids) is not 0:
-                            for pro_id in pro_ids:
-                                pro_id = str(int(pro_id))
-                                self.on_pro(pro_id)
-
-                    elif cmd == 'nick':
-                        old_nick = amf0_cmd[3]
-                        new_nick = amf0_cmd[4]
-                        nick_id = int(amf0_cmd[5])
-                        self.on_nick(old_nick, new_nick, nick_id)
-
-                    elif cmd == 'nickinuse':
-                        self.on_nickinuse()
-
-                    elif cmd == 'quit':
-                        quit_name = amf0_cmd[3]
-                        quit_id = amf0_cmd[4]
-                        self.on_quit(quit_id, quit_name)
-
-                    elif cmd == 'kick':
-                        kick_id = amf0_cmd[3]
-                        kick_name = amf0_cmd[4]
-                        self.on_kick(kick_id, kick_name)
-
-                    elif cmd == 'banned':
-                        self.on_banned()
-
-                    elif cmd == 'banlist':
-                        banlist_id_nick = amf0_cmd[3:]
-                        if len(banlist_id_nick) is not 0:
-                            while iparam0 < len(banlist_id_nick):
-                                banned_id = banlist_id_nick[iparam0]
-                                banned_nick = banlist_id_nick[iparam0 + 1]
-                                self.on_banlist(banned_id, banned_nick)
-                                iparam0 += 2
-
-                    elif cmd == 'startbanlist':
-                        # print(amf0_data)
-                        pass
-
-                    elif cmd == 'topic':
-                        topic = amf0_cmd[3]
-                        self.on_topic(topic)
-
-                    elif cmd == 'from_owner':
-                        owner_msg = amf0_cmd[3]
-                        self.on_from_owner(owner_msg)
-
-                    elif cmd == 'doublesignon':
-                        self.on_doublesignon()
-
-                    elif cmd == 'privmsg':
-                        raw_msg = amf0_cmd[4]
-                        msg_color = amf0_cmd[5]
-                        msg_sender = amf0_cmd[6]
-                        self.on_privmsg(msg_sender, raw_msg, msg_color)
-
-                    elif cmd == 'notice':
-                        notice_msg = amf0_cmd[3]
-                        notice_msg_id = amf0_cmd[4]
-                        if notice_msg == 'avon':
-                            avon_name = amf0_cmd[5]
-                            self.on_avon(notice_msg_id, avon_name)
-                        elif notice_msg == 'pro':
-                            self.on_pro(notice_msg_id)
-
-                    elif cmd == 'gift':
-                        gift_to = amf0_cmd[3]
-                        gift_sender = amf0_data[4]
-                        gift_info = amf0_data[5]
-                        self.on_gift(gift_sender, gift_to, gift_info)
-
-                    else:
-                        self.console_write(COLOR['bright_red'], 'Unknown command: %s' % cmd)
-
+                self._handle_amf(amf0_data)
             except Exception as ex:
                 log.error('general callback error: %s' % ex, exc_info=True)
                 if config.DEBUG_MODE:
                     traceback.print_exc()
 
+    def _handle_amf(self, amf0_data):
+        """ Handle a message from the RTMP application.
+
+        :param amf0_data: The message.
+        :type amf0_data: dict
+        """
+        if amf0_data['msg'] == rtmp.rtmp_type.DT_COMMAND:
+
+            create_stream_res = self.connection.is_create_stream_response(amf0_data)
+            if create_stream_res:
+                msg = 'create stream response, stream_id: %s' % self.connection.stream_id
+                log.info(msg)
+                self.connection.publish(self._client_id)
+                if config.DEBUG_MODE:
+                    self.console_write(COLOR['white'], msg)
+                return
+
+            if not self.dispatch_command(amf0_data['command']):
+                self.console_write(COLOR['bright_red'], 'Unknown command: %s' % amf0_data['command'][0])
+
+    def register_command(self, name, handler, **kwargs):
+        """ Register (or override) how this client dispatches a command.
+
+        Usage:
+            client.register_command('privmsg', my_privmsg_handler, start=4, stop=7)
+
+        :param name: The command name.
+        :type name: str
+        :param handler: The name of a client method, or a function taking the client and the arguments.
+        :type handler: str | callable | None
+        :param kwargs: See CommandSpec.
+        :return: The command spec.
+        :rtype: CommandSpec
+        """
+        spec = CommandSpec(name, handler, **kwargs)
+        self.commands[name] = spec
+        return spec
+
+    def dispatch_command(self, amf0_cmd, greenroom=False):
+        """ Call the handler of a command, as registered in the commands table.
+
+        :param amf0_cmd: The command.
+        :type amf0_cmd: list
+        :param greenroom: True if the command is from the greenroom application.
+        :type greenroom: bool
+        :return: False if the command is not registered (for the greenroom), else True.
+        :rtype: bool
+        """
+        cmd = amf0_cmd[0]
+        spec = self.commands.get(cmd)
+        # the server can send any name, only registered ones get a counter of their own.
+        counted = cmd if spec is not None else 'unknown'
+        if greenroom:
+            self.green_command_counts[counted] += 1
+        else:
+            self.command_counts[counted] += 1
+
+        if spec is None or (greenroom and not spec.greenroom):
+            return False
+        if spec.handler is None:
+            return True
+
+        if callable(spec.handler):
+            handler = functools.partial(spec.handler, self)
+        else:
+            handler = getattr(self, spec.handler)
+        if greenroom:
+            handler = functools.partial(handler, greenroom=True)
+
+        for args in spec.unpack(amf0_cmd):
+            if spec.run_async:
+                self._run_async(handler, *args)
+            else:
+                handler(*args)
+        return True
+
+    def _on_join_cmd(self, join_info):
+        """ Handle a join command on a join worker, the joins of a user are handled in order. """
+        if self.manager is not None:
+            self.manager.join_pool.submit((self.roomname, join_info.get('id')), self.on_join, join_info)
+        else:
+            self._join_pool.submit(join_info.get('id'), self.on_join, join_info)
+
+    def _on_oper_cmd(self, uid, nick):
+        """ Handle an oper command pair, only single digit user ids are passed on. """
+        if len(uid) == 1:
+            self.on_oper(uid, nick)
+
+    def _on_notice_cmd(self, notice_msg, notice_msg_id, name=None, greenroom=False):
+        """ Handle a notice command, an avon (cam up) or pro notice. """
+        if notice_msg == 'avon':
+            self.on_avon(notice_msg_id, name, greenroom=greenroom)
+        elif notice_msg == 'pro' and not greenroom:
+            self.on_pro(notice_msg_id)
+
     # Callback Event Methods.
     def on_result(self, result_info, greenroom=False):
         """ Default NetConnection message containing info about the connection.
@@ -573,7 +756,11 @@ class TinychatRTMPClient(object):
         client.user_level = 0
 
         self.console_write(COLOR['bright_green'], 'registered with ID: %d' % self._client_id)
+        # getting the captcha key is a web request, keep it off the thread reading the messages.
+        self._run_async(self._send_captcha_key)
 
+    def _send_captcha_key(self):
+        """ Get the captcha key, and send the cauth and nick messages. """
         key = self.param.get_captcha_key(self._client_id)
         if key is None:
             self.console_write(COLOR['bright_red'],
@@ -856,8 +1043,7 @@ class TinychatRTMPClient(object):
                     if len(msg_cmd) == 4:
                         media_type = msg_cmd[1]
                         media_id = msg_cmd[2]
-                        threading.Thread(target=self.on_media_broadcast_start,
-                                         args=(media_type, media_id, msg_sender,)).start()
+                        self._run_async(self.on_media_broadcast_start, media_type, media_id, msg_sender)
 
             elif msg_cmd[0] == '/mbc':
                 if self.active_user.is_mod:
@@ -969,15 +1155,33 @@ class TinychatRTMPClient(object):
                            (usr_nick, media_type, time_point))
 
     # Message Methods.
+    def _moderation_sent(self, sent, process_name, nick):
+        """ Report a moderation message the send queue dropped, a lost kick or ban is not sent again.
+
+        :param sent: The return value of the connection's call or call_template.
+        :type sent: bool
+        :param process_name: The command of the message.
+        :type process_name: str
+        :param nick: The nick (or id) the message was for, if any.
+        :type nick: str | int
+        :return: sent
+        :rtype: bool
+        """
+        if not sent:
+            message = ('%s %s' % (process_name, nick)).strip()
+            log.error('%s: moderation lane full, %s was dropped.' % (self.roomname, message))
+            self.console_write(COLOR['bright_red'], 'Send queue full, %s was not sent.' % message)
+        return sent
+
     def send_bauth_msg(self):
         """ Get and send the bauth key needed before we can start a broadcast. """
         if self._bauth_key is not None:
-            self.connection.call('bauth', [u'' + self._bauth_key])
+            self.connection.call('bauth', [u'' + self._bauth_key], lane=sendqueue.LANE_CONTROL)
         else:
             _token = self.param.get_broadcast_token(self.nickname, self._client_id)
             if _token != 'PW':
                 self._bauth_key = _token
-                self.connection.call('bauth', [u'' + _token])
+                self.connection.call('bauth', [u'' + _token], lane=sendqueue.LANE_CONTROL)
 
     def send_cauth_msg(self, cauthkey):
         """ Send the cauth message, we need to send this before we can chat.
@@ -985,7 +1189,7 @@ class TinychatRTMPClient(object):
         :param cauthkey: The cauth key.
         :type cauthkey: str
         """
-        self.connection.call('cauth', [u'' + cauthkey])
+        self.connection.call('cauth', [u'' + cauthkey], lane=sendqueue.LANE_CONTROL)
 
     def send_owner_run_msg(self, msg):
         """ Send owner run message.
@@ -995,7 +1199,8 @@ class TinychatRTMPClient(object):
         """
         if self.is_client_mod:
             msg = string_util.quote_str(msg)
-            self.connection.call('owner_run', [u'notice' + msg])
+            sent = self.connection.call('owner_run', [u'notice' + msg], lane=sendqueue.LANE_MODERATION)
+            self._moderation_sent(sent, 'notice', '')
 
     def send_cam_approve_msg(self, nick, uid=None):
         """ Send cam approval message.
@@ -1011,11 +1216,16 @@ class TinychatRTMPClient(object):
             if uid is None:
                 _user = self.users.search(nick)
                 if _user is not None:
-                    self.connection.call('privmsg', [u'' + self._encode_msg(msg), u'#0,en',
-                                                     u'n' + str(_user.id) + '-' + nick])
+                    sent = self.connection.call_template(PRIVMSG_TEMPLATE,
+                                                         [u'' + self._encode_msg(msg), u'#0,en',
+                                                          u'n' + str(_user.id) + '-' + nick],
+                                                         lane=sendqueue.LANE_MODERATION)
+                    self._moderation_sent(sent, 'cam approve', nick)
             else:
-                self.connection.call('privmsg',
-                                     [u'' + self._encode_msg(msg), u'#0,en', u'n' + str(uid) + '-' + nick])
+                sent = self.connection.call_template(PRIVMSG_TEMPLATE, [u'' + self._encode_msg(msg), u'#0,en',
+                                                                        u'n' + str(uid) + '-' + nick],
+                                                     lane=sendqueue.LANE_MODERATION)
+                self._moderation_sent(sent, 'cam approve', nick)
 
     def send_chat_msg(self, msg):
         """  Send a chat room message.
@@ -1023,7 +1233,7 @@ class TinychatRTMPClient(object):
         :param msg: The message to send.
         :type msg: str
         """
-        self.connection.call('privmsg', [u'' + self._encode_msg(msg), u'#262626,en'])
+        self.connection.call_template(PRIVMSG_TEMPLATE, [u'' + self._encode_msg(msg), u'#262626,en'])
 
     def send_private_msg(self, msg, nick):
         """ Send a private message.
@@ -1035,10 +1245,12 @@ class TinychatRTMPClient(object):
         """
         _user = self.users.search(nick)
         if _user is not None:
-            self.connection.call('privmsg', [u'' + self._encode_msg('/msg ' + nick + ' ' + msg),
-                                             u'#262626,en', u'n' + str(_user.id) + '-' + nick])
-            self.connection.call('privmsg', [u'' + self._encode_msg('/msg ' + nick + ' ' + msg),
-                                             u'#262626,en', u'b' + str(_user.id) + '-' + nick])
+            encoded_msg = u'' + self._encode_msg('/msg ' + nick + ' ' + msg)
+            with self.connection.corked():
+                self.connection.call_template(PRIVMSG_TEMPLATE, [encoded_msg, u'#262626,en',
+                                                                 u'n' + str(_user.id) + '-' + nick])
+                self.connection.call_template(PRIVMSG_TEMPLATE, [encoded_msg, u'#262626,en',
+                                                                 u'b' + str(_user.id) + '-' + nick])
 
     def send_userinfo_request_msg(self, user_id):
         """ Send user info request to a user.
@@ -1063,19 +1275,21 @@ class TinychatRTMPClient(object):
         """
         _user = self.users.search(nick)
         if _user is not None:
-            if use_b:
-                self.connection.call('privmsg', [u'' + self._encode_msg(msg),
-                                                 '#0,en', u'b' + str(_user.id) + '-' + nick])
-            if use_n:
-                self.connection.call('privmsg', [u'' + self._encode_msg(msg),
-                                                 '#0,en', u'n' + str(_user.id) + '-' + nick])
+            encoded_msg = u'' + self._encode_msg(msg)
+            with self.connection.corked():
+                if use_b:
+                    self.connection.call_template(PRIVMSG_TEMPLATE, [encoded_msg,
+                                                                     '#0,en', u'b' + str(_user.id) + '-' + nick])
+                if use_n:
+                    self.connection.call_template(PRIVMSG_TEMPLATE, [encoded_msg,
+                                                                     '#0,en', u'n' + str(_user.id) + '-' + nick])
 
     def set_nick(self):
         """ Send the nick message. """
         if not self.nickname:
             self.nickname = string_util.create_random_string(5, 25)
         self.console_write(COLOR['bright_magenta'], 'Setting nick: %s' % self.nickname)
-        self.connection.call('nick', [u'' + self.nickname])
+        self.connection.call('nick', [u'' + self.nickname], lane=sendqueue.LANE_CONTROL)
 
     def send_ban_msg(self, nick, uid=None):
         """ Send ban message.
@@ -1089,9 +1303,12 @@ class TinychatRTMPClient(object):
             if uid is None:
                 _user = self.users.search(nick)
                 if _user is not None:
-                    self.connection.call('kick', [u'' + nick, str(_user.id)])
+                    sent = self.connection.call('kick', [u'' + nick, str(_user.id)],
+                                                lane=sendqueue.LANE_MODERATION)
+                    self._moderation_sent(sent, 'kick', nick)
             else:
-                self.connection.call('kick', [u'' + nick, str(uid)])
+                sent = self.connection.call('kick', [u'' + nick, str(uid)], lane=sendqueue.LANE_MODERATION)
+                self._moderation_sent(sent, 'kick', nick)
 
     def send_forgive_msg(self, uid):
         """ Send forgive message.
@@ -1100,14 +1317,17 @@ class TinychatRTMPClient(object):
         :type uid: int | str
         """
         if self.is_client_mod:
-            self.connection.call('forgive', [u'' + str(uid)])
-            # get the updated ban list.
-            self.send_banlist_msg()
+            with self.connection.corked():
+                sent = self.connection.call('forgive', [u'' + str(uid)], lane=sendqueue.LANE_MODERATION)
+                self._moderation_sent(sent, 'forgive', uid)
+                # get the updated ban list.
+                self.send_banlist_msg()
 
     def send_banlist_msg(self):
         """ Send ban list message. """
         if self.is_client_mod:
-            self.connection.call('banlist')
+            sent = self.connection.call('banlist', lane=sendqueue.LANE_MODERATION)
+            self._moderation_sent(sent, 'banlist', '')
 
     def send_topic_msg(self, topic):
         """ Send a room topic message.
@@ -1125,7 +1345,8 @@ class TinychatRTMPClient(object):
         :type nick: str
         """
         if self.is_client_mod:
-            self.connection.call('owner_run', [u'_close' + nick])
+            sent = self.connection.call('owner_run', [u'_close' + nick], lane=sendqueue.LANE_MODERATION)
+            self._moderation_sent(sent, 'close', nick)
 
     # Media Message Functions
     def send_media_broadcast_start(self, media_type, video_id, time_point=0, private_nick=None):
@@ -1251,13 +1472,15 @@ class TinychatRTMPClient(object):
     # Timed Auto Method.
     def auto_job_handler(self):
         """ The event handler for auto_job_timer. """
+        if self._is_closed:
+            return
         if self.is_connected:
             self.param.get_config()
             if self.param.config_status is 3:
                 if self.is_client_mod:
                     if self.param.is_greenroom and not self.is_green_connected:
                         # if the greenroom has been enabled after we joined the room.
-                        threading.Thread(target=self.__connect_green).start()
+                        self._run_async(self.__connect_green)
                     elif not self.param.is_greenroom and self.is_green_connected:
                         # no need to keep the greenroom connection open
                         # if it is not enabled anymore.
@@ -1271,4 +1494,4 @@ class TinychatRTMPClient(object):
         fetch the room config from tinychat API every 5 minute(300 seconds)(default).
         See line 228 at http://tinychat.com/embed/chat.js
         """
-        threading.Timer(config.AUTO_JOB_INTERVAL, self.auto_job_handler).start()
+        self._auto_job = self._call_later(config.AUTO_JOB_INTERVAL, self.auto_job_handler)
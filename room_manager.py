@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+""" Host many rooms in one process. """
+
+import collections
+import logging
+import threading
+
+import apis.tinychat
+import config
+import pinylib
+import util.web
+from rtmplib import hub
+from util import pool, scheduler
+
+log = logging.getLogger(__name__)
+
+
+class RoomManager(object):
+    """
+    Hosts a number of TinychatRTMPClient's in one process.
+
+    Instead of the threads each client starts on its own (a callback loop per
+    connection, a thread per join, a timer per auto job), the clients of a
+    manager share one connection hub thread reading all connections, one
+    scheduler thread for timed jobs and a fixed pool of worker threads for
+    anything that blocks (connecting, web requests). The web session and the
+    tinychat api cache are shared by all clients in the process.
+
+    NOTE: the clients share the cookies of the web session,
+    so all rooms should use the same account (or none).
+    """
+    def __init__(self, workers=config.MANAGER_WORKERS, client_class=pinylib.TinychatRTMPClient):
+        """ Create a room manager.
+
+        :param workers: The number of worker threads.
+        :type workers: int
+        :param client_class: The client class to create for each room.
+        :type client_class: type
+        """
+        self.client_class = client_class
+        self.pool = pool.WorkerPool(workers, name='room-worker')
+        # runs on_join for all rooms, the joins of a user are handled in order.
+        self.join_pool = pool.StripedPool(config.JOIN_WORKERS, config.JOIN_QUEUE_SIZE, name='room-join')
+        self.scheduler = scheduler.Scheduler(name='room-scheduler')
+        self.hub = hub.ConnectionHub()
+        # client keyed by room name.
+        self.rooms = {}
+        self._hub_thread = None
+        self._lock = threading.Lock()
+        util.web.set_pool_size(pool_maxsize=config.HTTP_POOL_SIZE)
+        pinylib.open_api_store()
+
+    def start(self):
+        """ Start the worker, scheduler and hub threads. """
+        self.pool.start()
+        self.join_pool.start()
+        self.scheduler.start()
+        if self._hub_thread is None:
+            self._hub_thread = threading.Thread(target=self.hub.run, name='room-hub')
+            self._hub_thread.daemon = True
+            self._hub_thread.start()
+
+    def stop(self):
+        """ Remove all rooms and stop the threads. """
+        for room_name in list(self.rooms):
+            self.remove_room(room_name)
+        self.hub.stop()
+        self.scheduler.stop()
+        self.pool.stop()
+        self.join_pool.stop()
+        self._hub_thread = None
+
+    def add_room(self, room_name, nick='', account='', password='', room_pass=None, proxy=None):
+        """ Join a room.
+
+        The client is created right away, login and connect happen on a worker thread.
+
+        :param room_name: The room name.
+        :type room_name: str
+        :return: The client of the room, or None if the room was already added.
+        :rtype: pinylib.TinychatRTMPClient | None
+        """
+        with self._lock:
+            if room_name in self.rooms:
+                log.warning('room already added: %s' % room_name)
+                return None
+            client = self.client_class(room_name, nick=nick, account=account, password=password,
+                                       room_pass=room_pass, proxy=proxy)
+            client.manager = self
+            self.rooms[room_name] = client
+        self.pool.submit(self._join, client)
+        return client
+
+    def remove_room(self, room_name):
+        """ Leave a room.
+
+        :param room_name: The room name.
+        :type room_name: str
+        :return: True if the room was removed, False if it was not added.
+        :rtype: bool
+        """
+        with self._lock:
+            client = self.rooms.pop(room_name, None)
+        if client is None:
+            return False
+        client.close()
+        return True
+
+    def _join(self, client):
+        """ Login, set the rtmp parameters and connect a client. """
+        if client.account and client.password:
+            if not client.login():
+                log.error('%s: failed to login as %s' % (client.roomname, client.account))
+                client.account = ''
+                client.password = None
+        status = client.set_rtmp_parameters()
+        if status == 3:
+            client.connect()
+        else:
+            log.error('%s: failed to set rtmp parameters, %s' % (client.roomname, status))
+
+    def room_messages(self):
+        """ The number of messages received in each room, greenroom included.
+
+        :return: The message count keyed by room name.
+        :rtype: dict
+        """
+        counts = {}
+        for room_name, client in list(self.rooms.items()):
+            messages = 0
+            for rtmp_client in (client.connection, client.green_connection):
+                connection = self.hub.connections.get(rtmp_client)
+                if connection is not None:
+                    messages += connection.messages
+            counts[room_name] = messages
+        return counts
+
+    def stats(self):
+        """ Aggregate stats of the rooms and the shared threads.
+
+        :return: The stats.
+        :rtype: dict
+        """
+        clients = list(self.rooms.values())
+        messages = 0
+        for connection in list(self.hub.connections.values()):
+            messages += connection.messages
+        send_queued = send_dropped = 0
+        send_latency_max_ms = 0.0
+        command_counts = collections.Counter()
+        for c in clients:
+            command_counts.update(c.command_counts)
+            if c.connection is not None and c.connection.send_queue is not None:
+                for lane in c.connection.send_queue.stats().values():
+                    send_queued += lane['depth']
+                    send_dropped += lane['dropped']
+                    send_latency_max_ms = max(send_latency_max_ms, lane['latency_max_ms'])
+        joins = self.join_pool.stats()
+        return {
+            'rooms': len(clients),
+            'connected': sum(1 for c in clients if c.is_connected),
+            'green_connected': sum(1 for c in clients if c.is_green_connected),
+            'users': sum(len(c.users.all) for c in clients),
+            'connections': len(self.hub),
+            'messages': messages,
+            'send_queued': send_queued,
+            'send_dropped': send_dropped,
+            'send_latency_max_ms': send_latency_max_ms,
+            'command_counts': dict(command_counts),
+            'api_cache': apis.tinychat.cache_stats(),
+            'pool_pending': self.pool.pending,
+            'pool_completed': self.pool.completed,
+            'pool_errors': self.pool.errors,
+            'join_pending': joins['pending'],
+            'join_max_pending': joins['max_pending'],
+            'join_overflowed': joins['overflowed'],
+            'join_wait_avg_ms': joins['wait_avg_ms'],
+            'join_wait_max_ms': joins['wait_max_ms'],
+            'scheduled_jobs': len(self.scheduler),
+            'threads': threading.active_count()
+        }
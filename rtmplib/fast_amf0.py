@@ -0,0 +1,149 @@
+"""
+A fast AMF0 decoder for command message bodies.
+
+Tinychat command payloads only use numbers, booleans, strings, null,
+undefined, ECMA arrays and anonymous objects. This decoder reads those
+types directly from the message body with struct.unpack_from, and hands
+anything else to pyamf's amf0.Decoder. The decoded values are the same
+as pyamf's: integral numbers become int, strings are utf-8 decoded to
+unicode, object keys are left as bytes, ECMA arrays become
+pyamf.MixedArray and objects pyamf.ASObject.
+
+NOTE: elements decoded here are not added to a pyamf context, so an
+element that falls back to pyamf can not reference them. Tinychat does
+not use AMF0 references.
+"""
+import struct
+
+import pyamf
+from pyamf import amf0
+
+_UCHAR = struct.Struct('!B')
+_USHORT = struct.Struct('!H')
+_DOUBLE = struct.Struct('!d')
+
+_NUMBER = 0x00
+_BOOL = 0x01
+_STRING = 0x02
+_OBJECT = 0x03
+_NULL = 0x05
+_UNDEFINED = 0x06
+_MIXEDARRAY = 0x08
+_OBJECTTERM = 0x09
+_UNSUPPORTED = 0x0d
+
+
+class UnsupportedType(Exception):
+    """ Raised on a type the fast decoder does not handle. """
+    pass
+
+
+def _check_for_int(x):
+    """ Convert a float to an int if the values are equal, the same as pyamf does. """
+    try:
+        y = int(x)
+    except (OverflowError, ValueError):
+        pass
+    else:
+        if x == x and y == x:
+            return y
+    return x
+
+
+class Decoder(object):
+    """
+    Decodes AMF0 elements from a reader.BodyStream.
+
+    Provides the readElement method and stream attribute
+    of pyamf's amf0.Decoder, which is all the reader uses.
+    """
+    def __init__(self, stream):
+        """
+        :param stream: The message body.
+        :type stream: reader.BodyStream
+        """
+        self.stream = stream
+        # utf-8 bytes to unicode, like the string cache of a pyamf context.
+        self._strings = {}
+        self._fallback = None
+
+    def readElement(self):
+        """ Read the next element from the stream.
+
+        :return: The decoded element.
+        """
+        stream = self.stream
+        start = stream.pos
+        try:
+            value, stream.pos = self._read_element(stream.view, start)
+        except (UnsupportedType, struct.error):
+            # let pyamf decode (or fail on) the whole element.
+            stream.pos = start
+            if self._fallback is None:
+                self._fallback = amf0.Decoder(stream)
+            return self._fallback.readElement()
+        return value
+
+    def _read_string(self, view, pos):
+        length = _USHORT.unpack_from(view, pos)[0]
+        pos += 2
+        if pos + length > len(view):
+            raise struct.error('string past the end of the stream')
+        return view[pos:pos + length].tobytes(), pos + length
+
+    def _read_attributes(self, view, pos):
+        attrs = {}
+        key, pos = self._read_string(view, pos)
+        while _UCHAR.unpack_from(view, pos)[0] != _OBJECTTERM:
+            attrs[key], pos = self._read_element(view, pos)
+            key, pos = self._read_string(view, pos)
+        # skip the end marker.
+        return attrs, pos + 1
+
+    def _read_element(self, view, pos):
+        """ Decode the element at pos.
+
+        :return: The element and the position following it.
+        :rtype: tuple
+        """
+        marker = _UCHAR.unpack_from(view, pos)[0]
+        pos += 1
+
+        if marker == _STRING:
+            data, pos = self._read_string(view, pos)
+            value = self._strings.get(data)
+            if value is None:
+                value = self._strings[data] = data.decode('utf-8')
+            return value, pos
+
+        elif marker == _NUMBER:
+            return _check_for_int(_DOUBLE.unpack_from(view, pos)[0]), pos + 8
+
+        elif marker == _NULL or marker == _UNSUPPORTED:
+            return None, pos
+
+        elif marker == _BOOL:
+            return bool(_UCHAR.unpack_from(view, pos)[0]), pos + 1
+
+        elif marker == _OBJECT:
+            obj = pyamf.ASObject()
+            attrs, pos = self._read_attributes(view, pos)
+            obj.update(attrs)
+            return obj, pos
+
+        elif marker == _MIXEDARRAY:
+            # the array length is not used.
+            obj = pyamf.MixedArray()
+            attrs, pos = self._read_attributes(view, pos + 4)
+            for key, value in attrs.iteritems():
+                try:
+                    key = int(key)
+                except ValueError:
+                    pass
+                obj[key] = value
+            return obj, pos
+
+        elif marker == _UNDEFINED:
+            return pyamf.Undefined, pos
+
+        raise UnsupportedType(marker)
@@ -10,54 +10,119 @@ This is a edited version of rtmp-python based on the original by prekageo
 https://github.com/prekageo/rtmp-python
 """
 import logging
+import struct
 
 log = logging.getLogger(__name__)
 
+# The number of message header bytes for each header type (the 2 high bits of the first byte).
+MESSAGE_HEADER_SIZES = (11, 7, 3, 0)
 
-def decode(stream):
+# timestamp (24 bit), body length (24 bit), data type.
+_TIMESTAMP_LENGTH_TYPE = struct.Struct('>HBHBB')
+# timestamp (24 bit), body length (24 bit).
+_TIMESTAMP_LENGTH = struct.Struct('>HBHB')
+# timestamp (24 bit).
+_TIMESTAMP = struct.Struct('>HB')
+_UCHAR = struct.Struct('>B')
+_ULONG = struct.Struct('>L')
+# streamId is little endian.
+_STREAM_ID = struct.Struct('<L')
+
+# Pre-encoded (basic header, message header tail) bytes keyed by
+# (header size, channel_id, data_type, stream_id). The set of combinations
+# the writer emits is small, so the cache is not bounded.
+_encode_cache = {}
+
+
+def header_length(first_byte):
     """
-    Reads a header from the incoming stream.
+    Returns the number of bytes following the first byte of an encoded header,
+    not counting an extended timestamp.
 
-    A header can be of varying lengths and the properties that get updated
-    depend on the length.
+    @param first_byte: The first byte of the header.
+    @type first_byte: C{int}
+    @rtype: C{int}
+    """
+    length = MESSAGE_HEADER_SIZES[first_byte >> 6]
+    channel_id = first_byte & 0x3f
+    if channel_id == 0:
+        length += 1
+    elif channel_id == 1:
+        length += 2
+    return length
 
-    @param stream: The byte stream to read the header from.
-    @type stream: C{pyamf.util.BufferedByteStream}
-    @return: The read header from the stream.
+
+def unpack_from(first_byte, data, offset=0):
+    """
+    Decodes a header from its first byte and the L{header_length} bytes
+    found at C{offset} in C{data}.
+
+    If the timestamp field is 0xffffff, an extended timestamp follows the
+    header and it is up to the caller to read it.
+
+    @param first_byte: The first byte of the header.
+    @type first_byte: C{int}
+    @param data: The remaining bytes of the header.
+    @type data: C{str} | C{bytearray} | C{memoryview}
+    @param offset: The offset of the remaining bytes in data.
+    @type offset: C{int}
     @rtype: L{Header}
     """
-    # read the size and channel_id
-    channel_id = stream.read_uchar()
-    bits = channel_id >> 6
-    channel_id &= 0x3f
+    bits = first_byte >> 6
+    channel_id = first_byte & 0x3f
 
     if channel_id == 0:
-        channel_id = stream.read_uchar() + 64
-
-    if channel_id == 1:
-        channel_id = stream.read_uchar() + 64 + (stream.read_uchar() << 8)
+        channel_id = _UCHAR.unpack_from(data, offset)[0] + 64
+        offset += 1
+    elif channel_id == 1:
+        low, high = struct.unpack_from('BB', data, offset)
+        channel_id = low + 64 + (high << 8)
+        offset += 2
 
     header = Header(channel_id)
 
     if bits == 3:
         return header
 
-    header.timestamp = stream.read_24bit_uint()
-
-    if bits < 2:
-        header.body_length = stream.read_24bit_uint()
-        header.data_type = stream.read_uchar()
+    if bits == 2:
+        high, low = _TIMESTAMP.unpack_from(data, offset)
+        header.timestamp = high << 8 | low
+        return header
 
-    if bits < 1:
-        # streamId is little endian
-        stream.endian = '<'
-        header.stream_id = stream.read_ulong()
-        stream.endian = '!'
+    ts_high, ts_low, len_high, len_low, header.data_type = _TIMESTAMP_LENGTH_TYPE.unpack_from(data, offset)
+    header.timestamp = ts_high << 8 | ts_low
+    header.body_length = len_high << 8 | len_low
 
+    if bits == 0:
+        header.stream_id = _STREAM_ID.unpack_from(data, offset + 7)[0]
         header.full = True
 
+    return header
+
+
+def decode(stream):
+    """
+    Reads a header from the incoming stream.
+
+    A header can be of varying lengths and the properties that get updated
+    depend on the length.
+
+    @param stream: The byte stream to read the header from.
+    @type stream: C{pyamf.util.BufferedByteStream}
+    @return: The read header from the stream.
+    @rtype: L{Header}
+    """
+    # the first byte holds the header type and the channel_id (or
+    # how many bytes of the rest of the header the channel_id needs)
+    first_byte = ord(stream.read(1))
+    length = header_length(first_byte)
+    if length == 0:
+        return Header(first_byte & 0x3f)
+
+    header = unpack_from(first_byte, stream.read(length))
+
     if header.timestamp == 0xffffff:
-        header.timestamp = stream.read_ulong()
+        header.timestamp = _ULONG.unpack(stream.read(4))[0]
     # WORKAROUND: even though the RTMP specification states that the
     # extended timestamp field DOES NOT follow type 3 chunks, it seems
     # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
@@ -66,71 +131,98 @@ def decode(stream):
     # if header.timestamp >= 0x00ffffff:
     #     self.stream.read_ulong()
 
-    log.info('header recv: %s' % header)
-
     return header
 
 
-def encode(stream, header, previous=None):
+def _encode_parts(size, header):
     """
-    Encodes a RTMP header to C{stream}.
+    Returns the invariant parts of an encoded header, the basic header
+    and the part of the message header that follows the body length.
+    """
+    key = (size, header.channel_id, header.data_type, header.stream_id)
+    try:
+        return _encode_cache[key]
+    except KeyError:
+        pass
 
-    We expect the stream to already be in network endian mode.
+    channel_id = header.channel_id
 
-    The channel id can be encoded in up to 3 bytes. The first byte is special as
-    it contains the size of the rest of the header as described in
-    L{getHeaderSize}.
+    if channel_id < 64:
+        basic = _UCHAR.pack(size | channel_id)
+    elif channel_id < 320:
+        basic = struct.pack('BB', size, channel_id - 64)
+    else:
+        channel_id -= 64
+        basic = struct.pack('BBB', size + 1, channel_id & 0xff, channel_id >> 0x08)
 
-    0 >= channel_id > 64: channel_id
-    64 >= channel_id > 320: 0, channel_id - 64
-    320 >= channel_id > 0xffff + 64: 1, channel_id - 64 (written as 2 byte int)
+    if size == 0:
+        tail = _UCHAR.pack(header.data_type) + _STREAM_ID.pack(header.stream_id)
+    elif size == 0x40:
+        tail = _UCHAR.pack(header.data_type)
+    else:
+        tail = b''
+
+    _encode_cache[key] = basic, tail
+    return basic, tail
+
+
+def pack(header, previous=None):
+    """
+    Encodes a RTMP header and returns the encoded bytes.
+
+    See L{encode} for details.
 
-    @param stream: The stream to write the encoded header.
-    @type stream: L{util.BufferedByteStream}
     @param header: The L{Header} to encode.
     @param previous: The previous header (if any).
+    @rtype: C{str}
     """
-    log.debug('header send: %s' % header)
     if previous is None:
         size = 0
     else:
         size = min_bytes_required(header, previous)
 
-    channel_id = header.channel_id
+    basic, tail = _encode_parts(size, header)
 
-    if channel_id < 64:
-        stream.write_uchar(size | channel_id)
-    elif channel_id < 320:
-        stream.write_uchar(size)
-        stream.write_uchar(channel_id - 64)
+    if size == 0xc0:
+        return basic
+
+    timestamp = header.timestamp
+    if timestamp >= 0xffffff:
+        ts_field = 0xffffff
     else:
-        channel_id -= 64
+        ts_field = timestamp
 
-        stream.write_uchar(size + 1)
-        stream.write_uchar(channel_id & 0xff)
-        stream.write_uchar(channel_id >> 0x08)
+    if size <= 0x40:
+        body_length = header.body_length
+        data = basic + _TIMESTAMP_LENGTH.pack(ts_field >> 8, ts_field & 0xff,
+                                              body_length >> 8, body_length & 0xff) + tail
+    else:
+        data = basic + _TIMESTAMP.pack(ts_field >> 8, ts_field & 0xff)
 
-    if size == 0xc0:
-        return
+    if timestamp >= 0xffffff:
+        data += _ULONG.pack(timestamp)
 
-    if size <= 0x80:
-        if header.timestamp >= 0xffffff:
-            stream.write_24bit_uint(0xffffff)
-        else:
-            stream.write_24bit_uint(header.timestamp)
+    return data
 
-    if size <= 0x40:
-        stream.write_24bit_uint(header.body_length)
-        stream.write_uchar(header.data_type)
 
-    if size == 0:
-        stream.endian = '<'
-        stream.write_ulong(header.stream_id)
-        stream.endian = '!'
+def encode(stream, header, previous=None):
+    """
+    Encodes a RTMP header to C{stream}.
 
-    if size <= 0x80:
-        if header.timestamp >= 0xffffff:
-            stream.write_ulong(header.timestamp)
+    The channel id can be encoded in up to 3 bytes. The first byte is special as
+    it contains the size of the rest of the header as described in
+    L{getHeaderSize}.
+
+    0 >= channel_id > 64: channel_id
+    64 >= channel_id > 320: 0, channel_id - 64
+    320 >= channel_id > 0xffff + 64: 1, channel_id - 64 (written as 2 byte int)
+
+    @param stream: The stream to write the encoded header.
+    @type stream: L{util.BufferedByteStream}
+    @param header: The L{Header} to encode.
+    @param previous: The previous header (if any).
+    """
+    stream.write(pack(header, previous))
 
 
 class Header(object):
@@ -168,6 +260,50 @@ class Header(object):
             id(self))
 
 
+def merge(previous, header, delta=0):
+    """
+    Completes a partial header with the values of the previous header
+    on the same chunk stream.
+
+    The timestamp of a type 1 or type 2 header is a delta to the previous
+    timestamp. A type 3 header carries no timestamp at all, so the delta of
+    the previous message on the chunk stream is used.
+
+    @param previous: The last complete header on the chunk stream.
+    @type previous: L{Header}
+    @param header: The header as decoded from the stream.
+    @type header: L{Header}
+    @param delta: The timestamp delta of the previous message on the chunk stream.
+    @type delta: C{int}
+    @return: A complete header.
+    @rtype: L{Header}
+    """
+    if header.full:
+        return header
+
+    if previous is None:
+        raise Exception('HeaderError: no previous header to merge with %r' % header)
+
+    if previous.channel_id != header.channel_id:
+        raise Exception('HeaderError: channel_id mismatch on merge previous=%r, header=%r' % (previous, header))
+
+    if header.timestamp != -1:
+        delta = header.timestamp
+
+    merged = Header(channel_id=header.channel_id,
+                    timestamp=(previous.timestamp + delta) & 0xffffffff,
+                    data_type=previous.data_type,
+                    body_length=previous.body_length,
+                    stream_id=previous.stream_id,
+                    full=True)
+
+    if header.body_length != -1:
+        merged.body_length = header.body_length
+        merged.data_type = header.data_type
+
+    return merged
+
+
 def min_bytes_required(old, new):
     """
     Returns the number of bytes needed to de/encode the header based on the
@@ -0,0 +1,208 @@
+"""
+Drive many RTMP connections from one thread.
+
+A ConnectionHub registers the sockets of connected RtmpClient's with a
+selector, feeds the bytes received on each of them into a per connection
+reader.RtmpParser and hands the complete messages to a callback.
+
+The sockets are left in blocking mode and are only read when the selector
+reports them readable, so a read never blocks the hub, and the blocking
+send methods of RtmpClient (call, call_template etc.) keep working from
+any thread.
+"""
+import logging
+import socket
+import threading
+
+try:
+    import selectors
+except ImportError:
+    # python 2, pip install selectors2
+    import selectors2 as selectors
+
+from . import reader
+
+log = logging.getLogger(__name__)
+
+# the most bytes to read from a socket at once.
+READ_SIZE = 65536
+
+
+class Connection(object):
+    """ A client registered with a hub. """
+    __slots__ = ('client', 'parser', 'on_message', 'on_close', 'messages')
+
+    def __init__(self, client, parser, on_message, on_close):
+        self.client = client
+        self.parser = parser
+        self.on_message = on_message
+        self.on_close = on_close
+        # the number of messages dispatched.
+        self.messages = 0
+
+
+def _read_ahead(fileobject):
+    """ Returns (and removes) the bytes a socket file object has read ahead. """
+    rbuf = getattr(fileobject, '_rbuf', None)
+    if rbuf is None or not rbuf.tell():
+        return b''
+    data = rbuf.getvalue()
+    rbuf.seek(0)
+    rbuf.truncate()
+    return data
+
+
+class ConnectionHub(object):
+    """ Reads and dispatches the messages of many RTMP clients in one thread. """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # Connection keyed by client.
+        self.connections = {}
+        self._running = False
+        self._lock = threading.Lock()
+        # set when a client is added, or on stop, to wake run while there are no connections.
+        self._wakeup = threading.Event()
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, client, on_message, on_close=None):
+        """ Let the hub read the messages of a connected client.
+
+        The client must not be read from anywhere else once it is added.
+        Protocol messages are handled by the client (see RtmpClient.handle_packet)
+        before they are passed on, as RtmpClient.amf does.
+
+        :param client: A connected client.
+        :type client: rtmp.RtmpClient
+        :param on_message: Called with the client and the message for every message received.
+        :type on_message: callable
+        :param on_close: Called with the client and the error (or None) when the connection closes.
+        :type on_close: callable | None
+        """
+        parser = reader.RtmpParser(fast_amf0=client.fast_amf0)
+        if client.reader is not None:
+            # carry over the state of the blocking reader.
+            parser.chunk_size = client.reader.chunk_size
+            parser.chunk_streams = client.reader.chunk_streams
+            parser._bytes_fed = client.reader.bytes_read
+        parser.trace = client.trace
+        client.reader = parser
+
+        connection = Connection(client, parser, on_message, on_close)
+        with self._lock:
+            self.connections[client] = connection
+
+        # the bytes read ahead come before anything the hub reads from the socket,
+        # so they are dispatched here, before the hub thread can read it.
+        pending = _read_ahead(client.file)
+        if pending:
+            self._dispatch(connection, pending)
+
+        with self._lock:
+            if self.connections.get(client) is not connection:
+                # closed (or removed) while the bytes read ahead were dispatched.
+                return
+            self.selector.register(client.socket, selectors.EVENT_READ, connection)
+        self._wakeup.set()
+
+    def remove(self, client):
+        """ Stop reading the messages of a client. The connection is not closed.
+
+        :param client: The client to remove.
+        :type client: rtmp.RtmpClient
+        :return: True if the client was removed, False if it was not in the hub.
+        :rtype: bool
+        """
+        with self._lock:
+            connection = self.connections.pop(client, None)
+            if connection is None:
+                return False
+            try:
+                self.selector.unregister(client.socket)
+            except (KeyError, ValueError):
+                pass
+            return True
+
+    def poll(self, timeout=None):
+        """ Wait for data on the connections, and dispatch the received messages.
+
+        :param timeout: The most seconds to wait, None to wait until there is data.
+        :type timeout: float | None
+        :return: The number of connections that had data.
+        :rtype: int
+        """
+        events = self.selector.select(timeout)
+        for key, _ in events:
+            connection = key.data
+            try:
+                data = connection.client.socket.recv(READ_SIZE)
+            except socket.error as e:
+                self._close(connection, e)
+                continue
+            if not data:
+                self._close(connection, None)
+                continue
+            self._dispatch(connection, data)
+        return len(events)
+
+    def run(self, timeout=1.0):
+        """ Poll the connections until stop is called.
+
+        A client added while poll waits is picked up right away by the epoll and
+        kqueue selectors, the select based selectors pick it up within timeout.
+
+        :param timeout: The poll timeout, the most seconds until stop takes effect.
+        :type timeout: float
+        """
+        self._running = True
+        while self._running:
+            if self.selector.get_map():
+                self.poll(timeout)
+            else:
+                # selectors can not wait on nothing on every platform.
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+
+    def stop(self):
+        """ Stop run. """
+        self._running = False
+        self._wakeup.set()
+
+    def close(self):
+        """ Remove all clients, and close the selector. """
+        for client in list(self.connections):
+            self.remove(client)
+        self.selector.close()
+
+    def _dispatch(self, connection, data):
+        client = connection.client
+        try:
+            messages = connection.parser.feed(data)
+        except Exception as e:
+            if client.trace is not None:
+                log.error('amf read error, protocol trace:')
+                client.trace.dump(log, logging.ERROR)
+            self._close(connection, e)
+            return
+
+        for message in messages:
+            connection.messages += 1
+            try:
+                if client.handle:
+                    if client.handle_packet(message):
+                        log.debug('handled amf data: %s', message)
+                    client.acknowledge()
+                connection.on_message(client, message)
+            except Exception as e:
+                log.error('error dispatching message %s: %s', message, e, exc_info=True)
+
+    def _close(self, connection, error):
+        if not self.remove(connection.client):
+            return
+        log.debug('connection closed: %s', error)
+        if connection.on_close is not None:
+            try:
+                connection.on_close(connection.client, error)
+            except Exception as e:
+                log.error('error in close callback: %s', e, exc_info=True)
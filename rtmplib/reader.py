@@ -1,12 +1,232 @@
 import logging
+import struct
 
 from pyamf import amf0, amf3
 import pyamf.util.pure
 
-from . import header, rtmp_type
+from . import fast_amf0, header, rtmp_type, trace
 
 log = logging.getLogger(__name__)
 
+_UCHAR = struct.Struct('!B')
+_USHORT = struct.Struct('!H')
+_ULONG = struct.Struct('!L')
+_DOUBLE = struct.Struct('!d')
+
+# returned by RtmpParser.parse_chunk when the buffer does not hold a complete chunk.
+_INCOMPLETE = object()
+
+
+class BodyStream(pyamf.util.pure.DataTypeMixIn):
+    """
+    A read only byte stream over a memoryview of a reassembled message body.
+
+    Implements the part of the BufferedByteStream interface used by the amf
+    decoders, so a message body can be decoded without copying it into a new buffer.
+    """
+    def __init__(self, view):
+        """
+        :param view: The message body.
+        :type view: memoryview
+        """
+        pyamf.util.pure.DataTypeMixIn.__init__(self)
+        self.view = view
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, length=-1):
+        """ Read length bytes, or the rest of the stream if length is -1.
+
+        :raises IOError: when reading past the end of the stream.
+        """
+        if length == -1:
+            if self.at_eof():
+                raise IOError('Attempted to read from the buffer but already at the end')
+            length = len(self.view) - self.pos
+        elif self.pos + length > len(self.view):
+            raise IOError('Attempted to read %d bytes from the buffer but only %d remain' %
+                          (length, len(self.view) - self.pos))
+        data = self.view[self.pos:self.pos + length].tobytes()
+        self.pos += length
+        return data
+
+    def peek(self, size=1):
+        if size == -1:
+            size = len(self.view) - self.pos
+        return self.view[self.pos:self.pos + size].tobytes()
+
+    def seek(self, pos, mode=0):
+        if mode == 1:
+            pos += self.pos
+        elif mode == 2:
+            pos += len(self.view)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def remaining(self):
+        return len(self.view) - self.pos
+
+    def at_eof(self):
+        return self.pos >= len(self.view)
+
+    def _unpack(self, fmt):
+        if self.pos + fmt.size > len(self.view):
+            raise IOError('Tried to read %d byte(s) from the stream' % fmt.size)
+        value = fmt.unpack_from(self.view, self.pos)[0]
+        self.pos += fmt.size
+        return value
+
+    # The body is always in network byte order,
+    # so the most used readers can skip the endian lookup.
+    def read_uchar(self):
+        return self._unpack(_UCHAR)
+
+    def read_ushort(self):
+        return self._unpack(_USHORT)
+
+    def read_ulong(self):
+        return self._unpack(_ULONG)
+
+    def read_double(self):
+        return self._unpack(_DOUBLE)
+
+
+class LazyCommand(object):
+    """
+    The elements of a command message, decoded on access.
+
+    Only the command name and the transaction id are decoded up front. The
+    remaining elements are decoded from the message body the first time they
+    are accessed, so commands that are never looked at past the name cost
+    next to nothing to decode. Indexing decodes up to the requested element,
+    anything else (len, iteration, slicing, negative indexes) decodes all of them.
+    """
+    def __init__(self, decoder):
+        """
+        :param decoder: An amf decoder positioned at the start of the command.
+        """
+        self._decoder = decoder
+        self._elements = []
+        self._decode_to(1)
+        self.name = self._elements[0] if self._elements else None
+        self.transaction_id = self._elements[1] if len(self._elements) > 1 else None
+
+    def _decode_to(self, index):
+        """ Decode elements up to and including index, or all of them if index is None. """
+        decoder = self._decoder
+        if decoder is None:
+            return
+        elements = self._elements
+        while index is None or len(elements) <= index:
+            if decoder.stream.at_eof():
+                # release the decoder and with it the message body.
+                self._decoder = None
+                break
+            elements.append(decoder.readElement())
+
+    def __getitem__(self, index):
+        if type(index) is int and index >= 0:
+            self._decode_to(index)
+        else:
+            self._decode_to(None)
+        return self._elements[index]
+
+    def __len__(self):
+        self._decode_to(None)
+        return len(self._elements)
+
+    def __iter__(self):
+        self._decode_to(None)
+        return iter(self._elements)
+
+    def __contains__(self, item):
+        self._decode_to(None)
+        return item in self._elements
+
+    def __eq__(self, other):
+        self._decode_to(None)
+        return self._elements == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._decode_to(None)
+        return repr(self._elements)
+
+
+class ChunkStream(object):
+    """
+    The state of a single chunk stream.
+
+    Holds the last complete header and the body of the message
+    currently being received on the chunk stream.
+    """
+    __slots__ = ('header', 'delta', 'extended', 'body', 'view', 'received')
+
+    def __init__(self):
+        self.header = None
+        self.delta = 0
+        self.extended = False
+        self.body = None
+        self.view = None
+        self.received = 0
+
+    def merge(self, _header):
+        """ Complete the header of the first chunk of a message, without changing any state.
+
+        :param _header: The (possibly partial) header of the first chunk of the message.
+        :type _header: header.Header
+        :rtype: header.Header
+        """
+        return header.merge(self.header, _header, self.delta)
+
+    def begin(self, _header, merged=None):
+        """ Start a new message on the chunk stream.
+
+        :param _header: The (possibly partial) header of the first chunk of the message.
+        :type _header: header.Header
+        :param merged: The result of merge(_header), if already known.
+        :type merged: header.Header
+        """
+        if _header.timestamp != -1:
+            self.extended = _header.timestamp >= 0xffffff
+        if merged is None:
+            merged = self.merge(_header)
+        if _header.full:
+            self.delta = merged.timestamp
+        elif _header.timestamp != -1:
+            self.delta = _header.timestamp
+        self.header = merged
+
+        self.body = bytearray(merged.body_length)
+        self.view = memoryview(self.body)
+        self.received = 0
+
+    def remaining(self):
+        """ The number of body bytes still to be received. """
+        return self.header.body_length - self.received
+
+    def finish(self):
+        """ Hand over the complete message body and get ready for the next message.
+
+        :return: The message body.
+        :rtype: memoryview
+        """
+        view = self.view
+        self.abort()
+        return view
+
+    def abort(self):
+        """ Discard the message currently being received. """
+        self.body = None
+        self.view = None
+        self.received = 0
+
 
 class RtmpReader:
     """ This class reads RTMP messages from a stream. """
@@ -14,12 +234,24 @@ class RtmpReader:
     # default chunk size
     chunk_size = 128
 
-    def __init__(self, stream):
+    def __init__(self, stream, fast_amf0=False):
         """
         Initialize the RTMP reader and set it to read from the specified stream.
+
+        If fast_amf0 is True, command messages are decoded with fast_amf0.Decoder
+        instead of pyamf's amf0.Decoder.
         """
         self.stream = stream
-        self.prv_header = None
+        self.fast_amf0 = fast_amf0
+        # chunk stream state keyed by channel id.
+        self.chunk_streams = {}
+        # trace.ProtocolTrace, or None when tracing is disabled.
+        self.trace = None
+
+    @property
+    def bytes_read(self):
+        """ The number of bytes read from the stream. """
+        return self.stream.bytes_read
 
     def __iter__(self):
         # AttributeError: 'NoneType' object has no attribute 'next'
@@ -32,51 +264,68 @@ class RtmpReader:
         """ Read one RTMP message from the stream and return it. """
         if self.stream.at_eof():
             raise StopIteration
-        # Read the message into body_stream. The message may span a number of
-        # chunks (each one with its own header).
-        message_body = []
-        msg_body_len = 0
-        _header = header.decode(self.stream)
-        log.debug('header %s' % _header)
-
-        # FIXME: this should really be implemented inside header_decode
-        if _header.data_type == rtmp_type.DT_NONE:
-            _header = self.prv_header
-        self.prv_header = _header
-
-        while True:
-            # NOTE: this whole loop section needs to be looked at.
-            read_bytes = min(_header.body_length - msg_body_len, self.chunk_size)
-
-            message_body.append(self.stream.read(read_bytes))
-            msg_body_len += read_bytes
-            if msg_body_len >= _header.body_length:
-                break
-            next_header = header.decode(self.stream)
-            # WORKAROUND: even though the RTMP specification states that the
-            # extended timestamp field DOES NOT follow type 3 chunks, it seems
-            # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
-            # and expect this field here.
-            if _header.timestamp >= 0x00ffffff:
+        # A message may span a number of chunks (each one with its own header),
+        # and chunks of messages on other chunk streams may be interleaved with them.
+        # Every chunk is read straight into its place in the body of its chunk stream,
+        # until one of the chunk streams has a complete message.
+        message = None
+        while message is None:
+            _header = header.decode(self.stream)
+            if self.trace is not None:
+                self.trace.header(trace.HEADER_RECV, _header)
+
+            chunk_stream = self.chunk_streams.get(_header.channel_id)
+            if chunk_stream is None:
+                chunk_stream = ChunkStream()
+                self.chunk_streams[_header.channel_id] = chunk_stream
+
+            if _header.timestamp == -1 and chunk_stream.extended:
+                # WORKAROUND: even though the RTMP specification states that the
+                # extended timestamp field DOES NOT follow type 3 chunks, it seems
+                # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
+                # and expect this field here.
                 self.stream.read_ulong()
-            assert next_header.stream_id == -1, (_header, next_header)
-            assert next_header.data_type == -1, (_header, next_header)
-            assert next_header.timestamp == -1, (_header, next_header)
-            assert next_header.body_length == -1, (_header, next_header)
-        assert _header.body_length == msg_body_len, (_header, msg_body_len)
-        body_stream = pyamf.util.BufferedByteStream(''.join(message_body))
+
+            if chunk_stream.body is None:
+                chunk_stream.begin(_header)
+            else:
+                assert _header.timestamp == -1, (chunk_stream.header, _header)
+                assert _header.body_length == -1, (chunk_stream.header, _header)
+
+            read_bytes = min(chunk_stream.remaining(), self.chunk_size)
+            self.stream.readinto(chunk_stream.view[chunk_stream.received:chunk_stream.received + read_bytes])
+            chunk_stream.received += read_bytes
+
+            if chunk_stream.remaining() == 0:
+                message = self.decode_message(chunk_stream.header, chunk_stream.finish())
+        return message
+
+    def decode_message(self, _header, body_view):
+        """ Decode a complete message body.
+
+        :param _header: The complete header of the message.
+        :type _header: header.Header
+        :param body_view: The message body.
+        :type body_view: memoryview
+        :return: The decoded message, or None if the message should be skipped.
+        :rtype: dict | None
+        """
+        body_stream = BodyStream(body_view)
 
         # Decode the message based on the datatype present in the header
         ret = {'msg': _header.data_type}
 
         if ret['msg'] == rtmp_type.DT_NONE:
             log.warning('WARNING: message with datatype None received: %s' % _header)
-            return self.next()
+            return None
 
         elif ret['msg'] == rtmp_type.DT_USER_CONTROL:
             ret['event_type'] = body_stream.read_ushort()
             ret['event_data'] = body_stream.read()
 
+        elif ret['msg'] == rtmp_type.DT_ACKNOWLEDGEMENT:
+            ret['sequence_number'] = body_stream.read_ulong()
+
         elif ret['msg'] == rtmp_type.DT_WINDOW_ACK_SIZE:
             ret['window_ack_size'] = body_stream.read_ulong()
 
@@ -117,11 +366,10 @@ class RtmpReader:
             ret['events'] = events
 
         elif ret['msg'] == rtmp_type.DT_COMMAND:
-            decoder = amf0.Decoder(body_stream)
-            commands = []
-            while not body_stream.at_eof():
-                commands.append(decoder.readElement())
-            ret['command'] = commands
+            if self.fast_amf0:
+                ret['command'] = LazyCommand(fast_amf0.Decoder(body_stream))
+            else:
+                ret['command'] = LazyCommand(amf0.Decoder(body_stream))
 
         elif ret['msg'] == rtmp_type.DT_AMF3_COMMAND:
             decoder = amf3.Decoder(body_stream)
@@ -132,10 +380,20 @@ class RtmpReader:
 
         elif ret['msg'] == rtmp_type.DT_SET_CHUNK_SIZE:
             ret['chunk_size'] = body_stream.read_ulong()
+            # the new chunk size applies to the very next chunk.
+            if 0 < ret['chunk_size'] <= 65536:
+                self.chunk_size = ret['chunk_size']
+
+        elif ret['msg'] == rtmp_type.DT_ABORT:
+            ret['chunk_stream_id'] = body_stream.read_ulong()
+            chunk_stream = self.chunk_streams.get(ret['chunk_stream_id'])
+            if chunk_stream is not None:
+                chunk_stream.abort()
         else:
             assert False, _header
 
-        log.debug('recv %r', ret)
+        if self.trace is not None:
+            self.trace.message(trace.MSG_RECV, ret)
         return ret
 
     @staticmethod
@@ -192,3 +450,117 @@ class RtmpReader:
             assert False, event['type']
 
         return event
+
+
+class RtmpParser(RtmpReader):
+    """
+    Parses RTMP messages from bytes handed to it, without doing any IO.
+
+    Data can be fed in slices of any size, the parser keeps incomplete chunks
+    and the chunk stream state between calls to feed, and never blocks.
+    The messages are the same dicts RtmpReader.next returns.
+    """
+    def __init__(self, fast_amf0=False):
+        """ Initialize the RTMP parser. """
+        RtmpReader.__init__(self, None, fast_amf0=fast_amf0)
+        self.buffer = bytearray()
+        self.pos = 0
+        # the number of bytes fed to the parser.
+        self._bytes_fed = 0
+
+    @property
+    def bytes_read(self):
+        """ The number of bytes fed to the parser. """
+        return self._bytes_fed
+
+    def next(self):
+        """ A parser does not read, the messages are returned by feed. """
+        raise StopIteration
+
+    def feed(self, data):
+        """ Feed data to the parser.
+
+        :param data: Bytes received from the remote server.
+        :type data: str | bytearray | memoryview
+        :return: The messages completed by data, in the order they were received.
+        :rtype: list
+        """
+        self.buffer += data
+        self._bytes_fed += len(data)
+        messages = []
+        while True:
+            message = self.parse_chunk()
+            if message is _INCOMPLETE:
+                break
+            if message is not None:
+                messages.append(message)
+        # drop the parsed bytes, keeping an incomplete chunk for the next feed.
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        return messages
+
+    def parse_chunk(self):
+        """ Parse one chunk from the buffer.
+
+        :return: A message if the chunk completed one, None if it did not,
+        or _INCOMPLETE if the buffer does not hold a complete chunk.
+        """
+        buf = self.buffer
+        pos = self.pos
+        available = len(buf) - pos
+        if available < 1:
+            return _INCOMPLETE
+
+        first_byte = buf[pos]
+        length = 1 + header.header_length(first_byte)
+        if available < length:
+            return _INCOMPLETE
+
+        if length == 1:
+            _header = header.Header(first_byte & 0x3f)
+        else:
+            _header = header.unpack_from(first_byte, buf, pos + 1)
+            if _header.timestamp == 0xffffff:
+                if available < length + 4:
+                    return _INCOMPLETE
+                _header.timestamp = _ULONG.unpack_from(buf, pos + length)[0]
+                length += 4
+
+        chunk_stream = self.chunk_streams.get(_header.channel_id)
+        if chunk_stream is None:
+            chunk_stream = ChunkStream()
+            self.chunk_streams[_header.channel_id] = chunk_stream
+
+        if _header.timestamp == -1 and chunk_stream.extended:
+            # see the WORKAROUND in RtmpReader.next
+            length += 4
+
+        merged = None
+        if chunk_stream.body is None:
+            merged = chunk_stream.merge(_header)
+            remaining = merged.body_length
+        else:
+            assert _header.timestamp == -1, (chunk_stream.header, _header)
+            assert _header.body_length == -1, (chunk_stream.header, _header)
+            remaining = chunk_stream.remaining()
+
+        read_bytes = min(remaining, self.chunk_size)
+        if available < length + read_bytes:
+            return _INCOMPLETE
+
+        # the whole chunk is in the buffer, from here on the state changes.
+        if self.trace is not None:
+            self.trace.header(trace.HEADER_RECV, _header)
+        if merged is not None:
+            chunk_stream.begin(_header, merged)
+
+        start = pos + length
+        received = chunk_stream.received
+        chunk_stream.view[received:received + read_bytes] = memoryview(buf)[start:start + read_bytes]
+        chunk_stream.received += read_bytes
+        self.pos = start + read_bytes
+
+        if chunk_stream.remaining() == 0:
+            return self.decode_message(chunk_stream.header, chunk_stream.finish())
+        return None
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import random
 import socket
@@ -6,7 +7,7 @@ import time
 
 import pyamf.util.pure
 
-from . import packet, reader, writer, rtmp_type, socks
+from . import packet, reader, writer, rtmp_type, sendqueue, socks, trace
 
 
 log = logging.getLogger(__name__)
@@ -24,10 +25,65 @@ class FileDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
     """
     def __init__(self, fileobject):
         self.fileobject = fileobject
+        # the number of bytes read from the file.
+        self.bytes_read = 0
         pyamf.util.pure.DataTypeMixIn.__init__(self)
 
     def read(self, length):
-        return self.fileobject.read(length)
+        data = self.fileobject.read(length)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buf):
+        """ Read len(buf) bytes from the file into a writable buffer.
+
+        :param buf: The buffer to fill.
+        :type buf: memoryview | bytearray
+        :raises IOError: if the file ends before the buffer is filled.
+        """
+        length = len(buf)
+        if hasattr(self.fileobject, 'readinto'):
+            read_bytes = self.fileobject.readinto(buf)
+        elif hasattr(self.fileobject, '_sock'):
+            read_bytes = self._recv_into(memoryview(buf), length)
+        else:
+            data = self.fileobject.read(length)
+            read_bytes = len(data)
+            buf[:read_bytes] = data
+        self.bytes_read += read_bytes
+        if read_bytes != length:
+            raise IOError('Tried to read %d byte(s) from the stream, got %d' % (length, read_bytes))
+        return length
+
+    def _recv_into(self, view, length):
+        """ Fill a buffer from a python 2 socket file object, which has no readinto.
+
+        The bytes the file object has read ahead are used first,
+        the rest is received straight into the buffer.
+
+        :param view: The buffer to fill.
+        :type view: memoryview
+        :param length: The number of bytes to read.
+        :type length: int
+        :return: The number of bytes read, less than length if the connection closed.
+        :rtype: int
+        """
+        read_bytes = 0
+        rbuf = getattr(self.fileobject, '_rbuf', None)
+        if rbuf is not None and rbuf.tell():
+            data = rbuf.getvalue()
+            read_bytes = min(len(data), length)
+            view[:read_bytes] = data[:read_bytes]
+            rbuf.seek(0)
+            rbuf.truncate()
+            rbuf.write(data[read_bytes:])
+        sock = self.fileobject._sock
+        while read_bytes < length:
+            received = sock.recv_into(view[read_bytes:], length - read_bytes)
+            if not received:
+                break
+            read_bytes += received
+        return read_bytes
 
     def write(self, data):
         self.fileobject.write(data)
@@ -54,12 +110,24 @@ class RtmpClient:
         self.is_win = kwargs.get('is_win', False)
         self.handle = kwargs.get('handle', True)
         self.flash_version = kwargs.get('flash_version', 'WIN 22.0.0.209')
+        self.trace_size = kwargs.get('trace_size', 0)
+        self.fast_amf0 = kwargs.get('fast_amf0', False)
+        self.chunk_size = kwargs.get('chunk_size', None)
+        self.flush_budget = kwargs.get('flush_budget', 0)
+        # a (rate, burst) tuple per sendqueue lane, or None for no limits.
+        self.send_rates = kwargs.get('send_rates', None)
+        self.send_queue_size = kwargs.get('send_queue_size', 100)
+        # called with a delay and a function to send paced messages, see sendqueue.SendQueue
+        self.call_later = kwargs.get('call_later', None)
         self.shared_objects = []
         self.socket = None
         self.stream = None
         self.file = None
         self.writer = None
         self.reader = None
+        self.trace = None
+        self.send_queue = None
+        self.reset_flow_control()
 
         self.stream_id = 0
         self._transaction_id = 2
@@ -153,9 +221,13 @@ class RtmpClient:
             amf_data = self.reader.next()
             if self.handle:
                 if self.handle_packet(amf_data):
-                    log.debug('handled amf data: %s' % amf_data)
+                    log.debug('handled amf data: %s', amf_data)
+                self.acknowledge()
             return amf_data
         except Exception as e:
+            if self.trace is not None:
+                log.error('amf read error, protocol trace:')
+                self.trace.dump(log, logging.ERROR)
             raise AmfDataReadError(e)
 
     def handle_packet(self, amf_data):
@@ -172,8 +244,7 @@ class RtmpClient:
                 'event_type': rtmp_type.UC_PING_RESPONSE,
                 'event_data': amf_data['event_data'],
             }
-            self.writer.write(resp)
-            self.writer.flush()
+            self._send(resp)
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_USER_CONTROL and amf_data['event_type'] == rtmp_type.UC_PING_RESPONSE:
@@ -182,15 +253,18 @@ class RtmpClient:
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_WINDOW_ACK_SIZE:
-            assert amf_data['window_ack_size'] == 2500000, amf_data
+            self.window_ack_size = amf_data['window_ack_size']
+            log.debug('window acknowledgement size: %s', self.window_ack_size)
             ack_msg = {'msg': rtmp_type.DT_WINDOW_ACK_SIZE, 'window_ack_size': amf_data['window_ack_size']}
-            self.writer.write(ack_msg)
-            self.writer.flush()
+            self._send(ack_msg)
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_SET_PEER_BANDWIDTH:
-            assert amf_data['window_ack_size'] == 2500000, amf_data
-            assert amf_data['limit_type'] == 2, amf_data
+            self.set_peer_bandwidth(amf_data['window_ack_size'], amf_data['limit_type'])
+            return True
+
+        elif amf_data['msg'] == rtmp_type.DT_ACKNOWLEDGEMENT:
+            self.peer_bytes_acked = amf_data['sequence_number']
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_USER_CONTROL and amf_data['event_type'] == rtmp_type.UC_STREAM_BEGIN:
@@ -206,6 +280,89 @@ class RtmpClient:
         else:
             return False
 
+    def set_peer_bandwidth(self, window_size, limit_type):
+        """ Apply a set peer bandwidth message from the server.
+
+        A hard limit (0) sets the output bandwidth to window_size, a soft limit (1)
+        only lowers it, and a dynamic limit (2) is treated as hard if the previous
+        limit was hard, or if there was no previous limit, else it is ignored.
+        If the bandwidth changes, the new value is sent to the server as window
+        acknowledgement size.
+
+        :param window_size: The window size from the server.
+        :type window_size: int
+        :param limit_type: The limit type from the server.
+        :type limit_type: int
+        """
+        if limit_type == 2:
+            if self.peer_bandwidth_limit_type in (None, 0):
+                limit_type = 0
+            else:
+                log.debug('ignoring dynamic peer bandwidth limit: %s', window_size)
+                return
+
+        if limit_type == 0:
+            bandwidth = window_size
+        elif limit_type == 1:
+            if self.peer_bandwidth:
+                bandwidth = min(self.peer_bandwidth, window_size)
+            else:
+                bandwidth = window_size
+        else:
+            log.warning('unknown peer bandwidth limit type: %s', limit_type)
+            return
+
+        self.peer_bandwidth_limit_type = limit_type
+        if bandwidth != self.peer_bandwidth:
+            self.peer_bandwidth = bandwidth
+            log.debug('peer bandwidth: %s, limit type: %s', bandwidth, limit_type)
+            if bandwidth != self.window_ack_size:
+                ack_msg = {'msg': rtmp_type.DT_WINDOW_ACK_SIZE, 'window_ack_size': bandwidth}
+                self._send(ack_msg)
+
+    def acknowledge(self):
+        """ Send an acknowledgement if the bytes read since the last one
+        has reached the window acknowledgement size of the server.
+
+        :return: True if an acknowledgement was sent, else False.
+        :rtype: bool
+        """
+        if self.window_ack_size <= 0:
+            return False
+
+        bytes_read = self.reader.bytes_read
+        if bytes_read - self.bytes_acked < self.window_ack_size:
+            return False
+
+        # the sequence number is a 32 bit counter that wraps around.
+        ack_msg = {'msg': rtmp_type.DT_ACKNOWLEDGEMENT, 'sequence_number': bytes_read & 0xffffffff}
+        self._send(ack_msg)
+        self.bytes_acked = bytes_read
+        log.debug('acknowledged %s bytes', bytes_read)
+        return True
+
+    def reset_flow_control(self):
+        """ Reset the flow control state for a new connection.
+
+        window_ack_size is the window the server wants acknowledgements at,
+        bytes_acked the bytes read when the last acknowledgement was sent.
+        peer_bandwidth and peer_bandwidth_limit_type are the output bandwidth
+        set by the server, and peer_bytes_acked the last sequence number
+        the server acknowledged.
+        """
+        self.window_ack_size = 0
+        self.bytes_acked = 0
+        self.peer_bandwidth = 0
+        self.peer_bandwidth_limit_type = None
+        self.peer_bytes_acked = 0
+
+    @property
+    def bytes_read(self):
+        """ The number of bytes read from the server on this connection. """
+        if self.reader is None:
+            return 0
+        return self.reader.bytes_read
+
     def is_create_stream_response(self, amf_data):
         """ Check amf data to determine if it is a createStream response.
 
@@ -214,8 +371,9 @@ class RtmpClient:
         :return: True if the amf data was considered a response to a createStream message, else False.
         :rtype: bool
         """
-        if amf_data['msg'] == rtmp_type.DT_COMMAND and len(amf_data['command']) is 4:
-            if amf_data['command'][0] == '_result' and type(amf_data['command'][3]) is int:
+        # check the command name first, so other commands are not decoded further.
+        if amf_data['msg'] == rtmp_type.DT_COMMAND and amf_data['command'][0] == '_result':
+            if len(amf_data['command']) == 4 and type(amf_data['command'][3]) is int:
                 log.info('create stream response received, stream id : %s' % amf_data['command'][3])
                 self.stream_id = amf_data['command'][3]
                 self.writer.stream_id = self.stream_id
@@ -245,18 +403,39 @@ class RtmpClient:
         self.stream = FileDataTypeMixIn(self.file)
 
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # messages are batched with corked(), single messages should not wait for Nagle.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if self.is_win:
             self.socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 10000, 3000))
 
         self.handshake()
 
-        self.reader = reader.RtmpReader(self.stream)
-        self.writer = writer.RtmpWriter(self.stream)
+        self.send_queue = None
+        self.reset_flow_control()
+        self.reader = reader.RtmpReader(self.stream, fast_amf0=self.fast_amf0)
+        # the handshake is flushed, from here on the writer sends with the socket.
+        self.writer = writer.RtmpWriter(self.stream, sock=self.socket)
+        self.writer.flush_budget = self.flush_budget
+        if self.trace_size > 0:
+            self.trace = trace.ProtocolTrace(self.trace_size)
+            self.reader.trace = self.trace
+            self.writer.trace = self.trace
+
+        if self.chunk_size is not None:
+            self.writer.set_chunk_size(self.chunk_size)
 
         self._connect_rtmp(connect_params)
 
+        # from here on the client may be used by other threads, so every message
+        # goes through the send queue, which writes from one thread at a time.
+        self.send_queue = sendqueue.SendQueue(self.send_rates, self.send_queue_size,
+                                              writer=self.writer, call_later=self.call_later,
+                                              flush_budget=self.flush_budget)
+
     def shutdown(self):
         """ Closes the socket connection. """
+        if self.send_queue is not None:
+            self.send_queue.stop()
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
             self.socket.close()
@@ -278,7 +457,23 @@ class RtmpClient:
             self._transaction_id = 2
         return transaction_id
 
-    def call(self, process_name, parameters=None, trans_id=0):
+    def _send(self, message, lane=sendqueue.LANE_CONTROL):
+        """ Queue a message in a lane of the send queue, or write it before the queue is created.
+
+        :param message: The message.
+        :type message: dict
+        :param lane: The send queue lane.
+        :type lane: int
+        :return: False if the send queue dropped the message, else True.
+        :rtype: bool
+        """
+        if self.send_queue is None:
+            self.writer.write(message)
+            self.writer.flush()
+            return True
+        return self.send_queue.put(lane, self.writer.write, message)
+
+    def call(self, process_name, parameters=None, trans_id=0, lane=sendqueue.LANE_CHAT):
         """ Runs remote procedure calls (RPC) at the receiving end.
 
         :param process_name: The name of the remote method
@@ -287,6 +482,10 @@ class RtmpClient:
         :type parameters: list
         :param trans_id: The transaction Id for this call.
         :type trans_id: int
+        :param lane: The send queue lane, if the client has a send queue.
+        :type lane: int
+        :return: False if the send queue dropped the message, else True.
+        :rtype: bool
         """
         if parameters is None:
             parameters = []
@@ -301,8 +500,48 @@ class RtmpClient:
         }
         msg['command'].extend(parameters)
 
-        self.writer.write(msg)
-        self.writer.flush()
+        return self._send(msg, lane)
+
+    def call_template(self, template, parameters=None, lane=sendqueue.LANE_CHAT):
+        """ Runs a remote procedure call from a pre-encoded command template.
+
+        :param template: The command template, see writer.CommandTemplate
+        :type template: writer.CommandTemplate
+        :param parameters: A list of parameters to pass to the remote method.
+        :type parameters: list
+        :param lane: The send queue lane, if the client has a send queue.
+        :type lane: int
+        :return: False if the send queue dropped the message, else True.
+        :rtype: bool
+        """
+        if parameters is None:
+            parameters = []
+        if self.send_queue is None:
+            self.writer.write_command(template, parameters)
+            self.writer.flush()
+            return True
+        return self.send_queue.put(lane, self.writer.write_command, template, parameters)
+
+    @contextlib.contextmanager
+    def corked(self):
+        """ Context manager batching the messages sent inside it.
+
+        The messages are held back by the writer and sent together when the
+        context exits, or when the flush_budget (microseconds) runs out.
+        If the client has a send queue, the queue holds them back instead,
+        except control messages.
+
+        Usage:
+            with client.corked():
+                client.call('kick', [nick, uid])
+                client.call('banlist')
+        """
+        corked = self.writer if self.send_queue is None else self.send_queue
+        corked.cork()
+        try:
+            yield self
+        finally:
+            corked.uncork()
 
     def ping_request(self):
         """ Send a PING request. """
@@ -311,9 +550,8 @@ class RtmpClient:
             'event_type': rtmp_type.UC_PING_REQUEST,
             'event_data': struct.pack('>I', int(time.time()))
         }
-        log.debug('sending ping request to server: %s' % msg)
-        self.writer.write(msg)
-        self.writer.flush()
+        log.debug('sending ping request to server: %s', msg)
+        self._send(msg)
 
     def createstream(self):
         """ Send createStream message. """
@@ -321,8 +559,7 @@ class RtmpClient:
             'msg': rtmp_type.DT_COMMAND,
             'command': ['createStream', self._get_next_transaction_id(), None]
         }
-        self.writer.write(msg)
-        self.writer.flush()
+        self._send(msg)
 
     def closestream(self):
         """ Send closeStream message. """
@@ -330,8 +567,7 @@ class RtmpClient:
             'msg': rtmp_type.DT_COMMAND,
             'command': ['closeStream', 0, None]
         }
-        self.writer.write(msg)
-        self.writer.flush()
+        self._send(msg)
 
     def deletestream(self):
         """ Send deleteStream message. """
@@ -339,8 +575,7 @@ class RtmpClient:
             'msg': rtmp_type.DT_COMMAND,
             'command': ['deleteStream', 0, None]
         }
-        self.writer.write(msg)
-        self.writer.flush()
+        self._send(msg)
 
     def publish(self, publishing_name, publishing_type='live'):
         """ Send publish message.
@@ -354,5 +589,4 @@ class RtmpClient:
             'msg': rtmp_type.DT_COMMAND,
             'command': ['publish', 0, None, str(publishing_name), publishing_type]
         }
-        self.writer.write(msg)
-        self.writer.flush()
+        self._send(msg)
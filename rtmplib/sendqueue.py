@@ -0,0 +1,291 @@
+"""
+Paced outbound messages with priority lanes.
+
+A SendQueue holds the outbound messages of a connection in lanes, and sends
+them in lane order. Control messages (ping responses, acknowledgements etc.)
+go first, then moderation, then chat. Each lane can be paced by a token
+bucket, so a burst of chat messages is spread out instead of getting the
+client flood kicked, and never holds back the messages of a higher lane.
+
+Any thread can put messages, but only one thread at a time writes them. The
+lanes are deques, which append and pop atomically, and the thread that puts
+a message sends it (and anything else that is due) if no other thread is
+sending, else it leaves it to that thread. A thread putting a message never
+waits for another thread's send, and the messages of a connection are written
+by one thread at a time, in order.
+"""
+import collections
+import functools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# the lanes, in the order they are sent.
+LANE_CONTROL = 0
+LANE_MODERATION = 1
+LANE_CHAT = 2
+
+LANE_NAMES = ('control', 'moderation', 'chat')
+
+# lanes without a limit.
+UNPACED = [(0, 1)] * len(LANE_NAMES)
+
+
+class TokenBucket(object):
+    """ Allows rate messages per second, with bursts of up to burst messages. """
+    def __init__(self, rate, burst):
+        """
+        :param rate: Messages per second, 0 for no limit.
+        :type rate: int | float
+        :param burst: The most messages allowed at once.
+        :type burst: int
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now):
+        """ Seconds until a message is allowed, 0 if it is allowed now. """
+        if not self.rate:
+            return 0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """ Use a token for a message. Call delay first. """
+        if self.rate:
+            self.tokens -= 1
+
+
+class Lane(object):
+    """ The messages waiting in a lane, the lane's token bucket and counters. """
+    __slots__ = ('name', 'messages', 'bucket', 'max_size', 'sent', 'dropped', 'max_depth',
+                 'latency', 'max_latency')
+
+    def __init__(self, name, rate, burst, max_size):
+        self.name = name
+        # (time put, func, args)
+        self.messages = collections.deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.max_size = max_size
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # the total and the longest seconds from put to written.
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+
+class SendQueue(object):
+    """ Sends the outbound messages of a connection, paced per lane, from one thread at a time. """
+    def __init__(self, rates=None, max_size=100, writer=None, call_later=None, flush_budget=0):
+        """
+        :param rates: A (rate, burst) tuple per lane, see TokenBucket. None for no limits.
+        :type rates: list | None
+        :param max_size: The most messages waiting in a lane, further messages are dropped.
+        :type max_size: int
+        :param writer: If given, messages sent together are corked on this writer.RtmpWriter
+        :param call_later: Called with a delay and a function to send paced messages
+        once they are due. Defaults to a threading.Timer.
+        :type call_later: callable | None
+        :param flush_budget: If not 0, corked messages are sent at the latest
+        after this many microseconds.
+        :type flush_budget: int
+        """
+        if rates is None:
+            rates = UNPACED
+        self.lanes = [Lane(LANE_NAMES[i], rate, burst, max_size) for i, (rate, burst) in enumerate(rates)]
+        self.writer = writer
+        self._call_later = call_later
+        # held by the thread sending messages.
+        self._owner = threading.Lock()
+        # the time a send of paced messages is scheduled for, or None.
+        self._wakeup = None
+        # set by send, when the thread sending has to look at the lanes again.
+        self._dirty = False
+        self._corked = 0
+        self._cork_lock = threading.Lock()
+        self.flush_budget = flush_budget
+        # counts the outermost corks, so a flush budget timer only ends its own cork.
+        self._cork_generation = 0
+        # set when the flush budget of the current cork ran out.
+        self._cork_expired = False
+        self._running = True
+
+    def __len__(self):
+        """ The number of messages waiting in all lanes. """
+        return sum(len(lane.messages) for lane in self.lanes)
+
+    def stop(self):
+        """ Stop sending. Waiting messages are dropped. """
+        self._running = False
+        for lane in self.lanes:
+            lane.messages.clear()
+
+    def put(self, lane, func, *args):
+        """ Queue a message, and send it if nothing is ahead of it.
+
+        :param lane: The lane, LANE_CONTROL, LANE_MODERATION or LANE_CHAT.
+        :type lane: int
+        :param func: The function writing the message, called with args by the sending thread.
+        :return: False if the lane was full and the message was dropped, else True.
+        :rtype: bool
+        """
+        if not self._running:
+            return False
+        _lane = self.lanes[lane]
+        depth = len(_lane.messages)
+        if depth >= _lane.max_size:
+            _lane.dropped += 1
+            log.warning('%s lane full, dropping message.', _lane.name)
+            return False
+        _lane.messages.append((time.time(), func, args))
+        if depth >= _lane.max_depth:
+            _lane.max_depth = depth + 1
+        self.send()
+        return True
+
+    def cork(self):
+        """ Hold back the messages until uncork, so messages put together are sent together.
+
+        Control messages are not held back, a ping response or acknowledgement
+        must not wait for another thread's batch. If flush_budget is set, the
+        messages are not held back longer than that.
+        """
+        with self._cork_lock:
+            self._corked += 1
+            if self._corked > 1 or not self.flush_budget:
+                return
+            self._cork_expired = False
+            self._cork_generation += 1
+            generation = self._cork_generation
+        self._later(self.flush_budget / 1000000.0, functools.partial(self._flush_budget_expired, generation))
+
+    def uncork(self):
+        with self._cork_lock:
+            if self._corked == 0:
+                return
+            self._corked -= 1
+        self.send()
+
+    def send(self):
+        """ Send the messages that are due, unless another thread is sending. """
+        # tell the sending thread, if any, to look at the lanes again.
+        self._dirty = True
+        while self._running and self._owner.acquire(False):
+            try:
+                self._dirty = False
+                wait = self._send_due()
+            finally:
+                self._owner.release()
+            if self._dirty:
+                # a message put (or uncork) after the lanes were looked at, and before
+                # the lock was released, was left to this thread. It may be due now,
+                # even if the messages this thread left are paced.
+                continue
+            if wait is not None:
+                self._schedule(wait)
+            return
+
+    def stats(self):
+        """ The depth and counters of each lane.
+
+        :return: A dict keyed by lane name.
+        :rtype: dict
+        """
+        stats = {}
+        for lane in self.lanes:
+            stats[lane.name] = {
+                'depth': len(lane.messages),
+                'max_depth': lane.max_depth,
+                'sent': lane.sent,
+                'dropped': lane.dropped,
+                'latency_avg_ms': lane.latency / lane.sent * 1000 if lane.sent else 0.0,
+                'latency_max_ms': lane.max_latency * 1000
+            }
+        return stats
+
+    def _send_due(self):
+        """ Send messages until none is due. Must be called by the owner.
+
+        :return: The seconds until the next paced message is due, or None if no message can be sent.
+        :rtype: float | None
+        """
+        batch = self.writer is not None and len(self) > 1
+        if batch:
+            self.writer.cork()
+        try:
+            while self._running:
+                now = time.time()
+                wait = None
+                for lane in self._open_lanes():
+                    if not lane.messages:
+                        continue
+                    delay = lane.bucket.delay(now)
+                    if delay == 0:
+                        break
+                    if wait is None or delay < wait:
+                        wait = delay
+                else:
+                    return wait
+
+                lane.bucket.take()
+                put_time, func, args = lane.messages.popleft()
+                try:
+                    func(*args)
+                except Exception as e:
+                    log.error('send error: %s', e, exc_info=True)
+                latency = time.time() - put_time
+                lane.sent += 1
+                lane.latency += latency
+                if latency > lane.max_latency:
+                    lane.max_latency = latency
+        finally:
+            if batch:
+                self.writer.uncork()
+
+    def _open_lanes(self):
+        """ The lanes messages can be sent from, only the control lane while corked. """
+        if self._corked and not self._cork_expired:
+            return self.lanes[:1]
+        return self.lanes
+
+    def _flush_budget_expired(self, generation):
+        """ Send the corked messages, the cork held them back for flush_budget. """
+        with self._cork_lock:
+            if not self._corked or generation != self._cork_generation:
+                return
+            self._cork_expired = True
+        log.debug('flush budget expired, sending %s corked message(s).', len(self))
+        self.send()
+
+    def _schedule(self, wait):
+        """ Send again once the next paced message is due. """
+        now = time.time()
+        when = now + wait
+        if self._wakeup is not None and now < self._wakeup <= when:
+            return
+        self._wakeup = when
+        self._later(wait, self._on_wakeup)
+
+    def _later(self, delay, func):
+        """ Call func after delay seconds, with call_later or on a timer thread. """
+        if self._call_later is not None:
+            self._call_later(delay, func)
+        else:
+            timer = threading.Timer(delay, func)
+            timer.daemon = True
+            timer.start()
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self.send()
@@ -0,0 +1,121 @@
+"""
+Protocol tracing for RTMP connections.
+
+A ProtocolTrace keeps the most recent header and message events of a
+connection in a ring buffer. Events are stored as plain tuples and are
+only formatted when the trace is dumped, so recording is cheap, and a
+reader/writer without a trace (the default) only pays for a None check.
+"""
+import collections
+import logging
+import time
+
+from . import rtmp_type
+
+log = logging.getLogger(__name__)
+
+# === event kinds ===
+
+HEADER_RECV = 0
+
+HEADER_SEND = 1
+
+MSG_RECV = 2
+
+MSG_SEND = 3
+
+EVENT_NAMES = {
+    HEADER_RECV: 'header recv',
+    HEADER_SEND: 'header send',
+    MSG_RECV: 'recv',
+    MSG_SEND: 'send'
+}
+
+# default number of events to keep.
+DEFAULT_SIZE = 256
+
+
+class ProtocolTrace(object):
+    """ Ring buffer of the most recent protocol events of a connection. """
+    def __init__(self, size=DEFAULT_SIZE):
+        """ Create a protocol trace.
+
+        :param size: The maximum number of events to keep.
+        :type size: int
+        """
+        self.events = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.events)
+
+    def header(self, kind, _header):
+        """ Record a header event.
+
+        :param kind: HEADER_RECV or HEADER_SEND
+        :type kind: int
+        :param _header: The header.
+        :type _header: header.Header
+        """
+        self.events.append((time.time(), kind, _header.channel_id, _header.data_type,
+                            _header.timestamp, _header.body_length, _header.stream_id))
+
+    def message(self, kind, message):
+        """ Record a message event.
+
+        Only the data type and, for commands, the command name is kept.
+
+        :param kind: MSG_RECV or MSG_SEND
+        :type kind: int
+        :param message: The decoded message.
+        :type message: dict
+        """
+        data_type = message['msg']
+        if data_type == rtmp_type.DT_COMMAND or data_type == rtmp_type.DT_AMF3_COMMAND:
+            detail = message['command'][0] if message.get('command') else None
+        elif data_type == rtmp_type.DT_USER_CONTROL:
+            detail = message['event_type']
+        else:
+            detail = None
+        self.events.append((time.time(), kind, data_type, detail))
+
+    def command(self, kind, process_name):
+        """ Record a command message event without a message dict.
+
+        :param kind: MSG_RECV or MSG_SEND
+        :type kind: int
+        :param process_name: The command name.
+        :type process_name: str
+        """
+        self.events.append((time.time(), kind, rtmp_type.DT_COMMAND, process_name))
+
+    def clear(self):
+        """ Remove all events. """
+        self.events.clear()
+
+    def format(self):
+        """ Format the recorded events, oldest first.
+
+        :return: A list of formatted event lines.
+        :rtype: list
+        """
+        lines = []
+        for event in list(self.events):
+            ts = time.strftime('%H:%M:%S', time.localtime(event[0])) + '.%03d' % (event[0] % 1 * 1000)
+            if event[1] == HEADER_RECV or event[1] == HEADER_SEND:
+                lines.append('%s %s: channel_id=%s data_type=%s timestamp=%s body_length=%s stream_id=%s' %
+                             ((ts, EVENT_NAMES[event[1]]) + event[2:]))
+            else:
+                lines.append('%s %s: data_type=%s %s' % (ts, EVENT_NAMES[event[1]], event[2], event[3]))
+        return lines
+
+    def dump(self, logger=log, level=logging.DEBUG):
+        """ Write the recorded events to a logger.
+
+        :param logger: The logger to write to.
+        :type logger: logging.Logger
+        :param level: The logging level.
+        :type level: int
+        """
+        if logger.isEnabledFor(level):
+            for line in self.format():
+                logger.log(level, line)
@@ -1,12 +1,77 @@
 import logging
+import struct
+import threading
+import time
 
 from pyamf import amf0, amf3
 import pyamf.util.pure
 
-from . import header, rtmp_type
+from . import header, rtmp_type, trace
 
 log = logging.getLogger(__name__)
 
+_USHORT = struct.Struct('!H')
+_ULONG = struct.Struct('!L')
+
+# The most buffers handed to socket.sendmsg at once, well below IOV_MAX (1024 on linux).
+# Messages with more chunks are sent from the frame buffer with sendall.
+_MAX_SENDMSG_BUFFERS = 256
+
+
+class CommandTemplate(object):
+    """
+    A command message with a pre-encoded invariant part.
+
+    The command name, the transaction id and the command object (null) are
+    encoded once, so only the arguments are encoded when the command is sent.
+    String arguments, which is what most commands carry, are encoded directly,
+    anything else goes through pyamf's amf0.Encoder.
+    """
+    def __init__(self, process_name, trans_id=0):
+        """ Create a command template.
+
+        :param process_name: The name of the remote method.
+        :type process_name: str
+        :param trans_id: The transaction Id for the command.
+        :type trans_id: int
+        """
+        self.process_name = process_name
+        self.trans_id = trans_id
+
+        prefix_stream = pyamf.util.BufferedByteStream()
+        encoder = amf0.Encoder(prefix_stream)
+        for element in (process_name, trans_id, None):
+            encoder.writeElement(element)
+        self.prefix = prefix_stream.getvalue()
+
+    def encode(self, parameters):
+        """ Encode the command with the given arguments.
+
+        :param parameters: The arguments to the remote method.
+        :type parameters: list
+        :return: The encoded command message body.
+        :rtype: str
+        """
+        parts = [self.prefix]
+        for parameter in parameters:
+            if type(parameter) is unicode:
+                parameter = parameter.encode('utf-8')
+            elif type(parameter) is not str:
+                parts.append(self._encode_element(parameter))
+                continue
+
+            if len(parameter) > 0xffff:
+                parts.append(self._encode_element(parameter))
+            else:
+                parts.append('\x02' + _USHORT.pack(len(parameter)) + parameter)
+        return ''.join(parts)
+
+    @staticmethod
+    def _encode_element(element):
+        element_stream = pyamf.util.BufferedByteStream()
+        amf0.Encoder(element_stream).writeElement(element)
+        return element_stream.getvalue()
+
 
 class RtmpWriter:
     """ This class writes RTMP messages into a stream. """
@@ -14,19 +79,44 @@ class RtmpWriter:
     # default chunk size
     chunk_size = 128
 
-    def __init__(self, stream):
-        """ Initialize the RTMP writer and set it to write into the specified stream. """
+    def __init__(self, stream, sock=None):
+        """
+        Initialize the RTMP writer and set it to write into the specified stream.
+
+        If a socket is given, messages are sent with the socket directly,
+        using scatter/gather socket.sendmsg where available, instead of
+        writing them into the stream. The stream must then be unbuffered
+        for writes, or flushed, before the writer is used.
+        """
         self.stream = stream
+        self.sock = sock
+        self._use_sendmsg = sock is not None and hasattr(sock, 'sendmsg')
+        # the framed message (headers and chunks), reused for every message.
+        self._frame = bytearray()
+        self._lock = threading.Lock()
+        # cork depth, and the end of the framed messages waiting for uncork.
+        self._corked = 0
+        self._pending = 0
+        self._flush_timer = None
+        # if not 0, corked messages are sent at the latest after this many microseconds.
+        self.flush_budget = 0
+        # the last (absolute timestamp, header as sent) keyed by chunk stream id.
+        self._last_headers = {}
+        # message timestamps are milliseconds since the writer was created.
+        self._epoch = time.time()
 
         self.stream_id = 0
+        # trace.ProtocolTrace, or None when tracing is disabled.
+        self.trace = None
 
     def flush(self):
         """ Flush the underlying stream. """
         self.stream.flush()
 
     def write(self, message):
-        log.debug('send %r', message)
         """ Encode and write the specified message into the stream. """
+        if self.trace is not None:
+            self.trace.message(trace.MSG_SEND, message)
         datatype = message['msg']
         body_stream = pyamf.util.BufferedByteStream()
         encoder = amf0.Encoder(body_stream)
@@ -36,6 +126,14 @@ class RtmpWriter:
             body_stream.write(message['event_data'])
             self.send_msg(datatype, body_stream.getvalue())
 
+        elif datatype == rtmp_type.DT_SET_CHUNK_SIZE:
+            body_stream.write_ulong(message['chunk_size'])
+            self.send_msg(datatype, body_stream.getvalue())
+
+        elif datatype == rtmp_type.DT_ACKNOWLEDGEMENT:
+            body_stream.write_ulong(message['sequence_number'])
+            self.send_msg(datatype, body_stream.getvalue())
+
         elif datatype == rtmp_type.DT_WINDOW_ACK_SIZE:
             body_stream.write_ulong(message['window_ack_size'])
             self.send_msg(datatype, body_stream.getvalue())
@@ -81,6 +179,37 @@ class RtmpWriter:
         else:
             assert False, message
 
+    def set_chunk_size(self, chunk_size):
+        """ Tell the remote server the chunk size of the following messages, and use it.
+
+        The set chunk size message is sent with the current chunk size,
+        every message written after it is chunked with the new one.
+
+        :param chunk_size: The new chunk size, 1 - 65536.
+        :type chunk_size: int
+        """
+        if not 0 < chunk_size <= 65536:
+            raise ValueError('chunk size out of range: %s' % chunk_size)
+        message = {'msg': rtmp_type.DT_SET_CHUNK_SIZE, 'chunk_size': chunk_size}
+        if self.trace is not None:
+            self.trace.message(trace.MSG_SEND, message)
+        # no message of another thread may be chunked with the old size once the server has the new one.
+        with self._lock:
+            self._send_msg(message['msg'], _ULONG.pack(chunk_size))
+            self.chunk_size = chunk_size
+
+    def write_command(self, template, parameters):
+        """ Encode and write a command from a template into the stream.
+
+        :param template: The command template.
+        :type template: CommandTemplate
+        :param parameters: The arguments to the remote method.
+        :type parameters: list
+        """
+        if self.trace is not None:
+            self.trace.command(trace.MSG_SEND, template.process_name)
+        self.send_msg(rtmp_type.DT_COMMAND, template.encode(parameters))
+
     @staticmethod
     def write_shared_object_event(event, body_stream):
         inner_stream = pyamf.util.BufferedByteStream()
@@ -109,12 +238,21 @@ class RtmpWriter:
         body_stream.write_ulong(len(inner_stream))
         body_stream.write(inner_stream.getvalue())
 
-    def send_msg(self, data_type, body, chunk_id=3, stream_id=0, timestamp=0):
+    def send_msg(self, data_type, body, chunk_id=3, stream_id=0, timestamp=None):
         """
         Helper method that send the specified message into the stream. Takes
         care to prepend the necessary headers and split the message into
         appropriately sized chunks.
+
+        The header is compressed against the last header sent on the chunk stream,
+        see _frame_header. If timestamp is None, the time in milliseconds since the
+        writer was created is used.
         """
+        with self._lock:
+            self._send_msg(data_type, body, chunk_id, stream_id, timestamp)
+
+    def _send_msg(self, data_type, body, chunk_id=3, stream_id=0, timestamp=None):
+        """ See send_msg. Must be called with the lock held. """
         # Values that just work. :-)
         if 1 <= data_type <= 7:
             _channel_id = 2
@@ -123,16 +261,154 @@ class RtmpWriter:
             _channel_id = chunk_id
             _stream_id = stream_id
 
+        if timestamp is None:
+            timestamp = int((time.time() - self._epoch) * 1000)
+
         _header = header.Header(
             channel_id=_channel_id,  # i am pretty sure this is the chunk stream ID. Rename in header?
             stream_id=_stream_id,
             data_type=data_type,
             body_length=len(body),
-            timestamp=timestamp)
-        header.encode(self.stream, _header)
-
-        for i in xrange(0, len(body), self.chunk_size):
-            chunk = body[i:i + self.chunk_size]
-            self.stream.write(chunk)
-            if i+self.chunk_size < len(body):
-                header.encode(self.stream, _header, _header)
+            timestamp=timestamp & 0xffffffff)
+
+        if self.trace is not None:
+            self.trace.header(trace.HEADER_SEND, _header)
+
+        first, continuation = self._frame_header(_header, timestamp)
+        chunk_size = self.chunk_size
+        if len(body) <= chunk_size:
+            buffers = [first, body]
+        else:
+            # every chunk after the first gets a type 3 header.
+            view = memoryview(body)
+            buffers = [first, view[:chunk_size]]
+            for i in xrange(chunk_size, len(body), chunk_size):
+                buffers.append(continuation)
+                buffers.append(view[i:i + chunk_size])
+        self._send_buffers(buffers)
+
+    def _frame_header(self, _header, timestamp):
+        """
+        Encode the header of a message using the smallest header type
+        the last header sent on the chunk stream allows.
+
+        Must be called with the lock held, the headers must be sent in
+        the order they are encoded.
+
+        :param _header: The header, with the absolute timestamp.
+        :type _header: header.Header
+        :param timestamp: The absolute timestamp, not wrapped to 32 bits.
+        :type timestamp: int
+        :return: The encoded header, and the encoded type 3 header for the following chunks.
+        :rtype: tuple
+        """
+        last = self._last_headers.get(_header.channel_id)
+        if last is None or last[1].stream_id != _header.stream_id:
+            # type 0, the timestamp is absolute and is also the delta of a following type 3 header.
+            sent = _header
+            first = header.pack(sent)
+        else:
+            last_timestamp, previous = last
+            # the timestamp of a type 1, 2 or 3 header is the delta to the previous message,
+            # so a type 3 header is only used if the delta is the same as the previous one.
+            sent = header.Header(
+                channel_id=_header.channel_id,
+                stream_id=_header.stream_id,
+                data_type=_header.data_type,
+                body_length=_header.body_length,
+                timestamp=max(0, timestamp - last_timestamp) & 0xffffffff)
+            first = header.pack(sent, previous)
+
+        self._last_headers[_header.channel_id] = (max(timestamp, last[0]) if last else timestamp, sent)
+
+        continuation = header.pack(sent, sent)
+        if sent.timestamp >= 0xffffff:
+            # type 3 headers repeat an extended timestamp.
+            continuation += _ULONG.pack(sent.timestamp)
+            if len(first) == len(continuation) - 4:
+                first = continuation
+        return first, continuation
+
+    def cork(self):
+        """
+        Hold back the following messages until uncork is called,
+        so they can be sent together in as few TCP segments as possible.
+        Calls can be nested, the messages are sent by the outermost uncork.
+        """
+        with self._lock:
+            self._corked += 1
+
+    def uncork(self):
+        """ Send the messages held back since cork. """
+        with self._lock:
+            if self._corked == 0:
+                return
+            self._corked -= 1
+            if self._corked == 0:
+                self._send_pending()
+
+    def _send_pending(self):
+        """ Send the held back messages. Must be called with the lock held. """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._pending:
+            end = self._pending
+            self._pending = 0
+            self._send_frame(end)
+
+    def _flush_budget_expired(self):
+        with self._lock:
+            self._flush_timer = None
+            if self._pending:
+                log.debug('flush budget expired, sending %s corked byte(s)', self._pending)
+                self._send_pending()
+
+    def send_buffers(self, buffers):
+        """ Send the buffers of a framed message in one call.
+
+        :param buffers: The headers and chunks of the message, in order.
+        :type buffers: list
+        """
+        with self._lock:
+            self._send_buffers(buffers)
+
+    def _send_buffers(self, buffers):
+        """ See send_buffers. Must be called with the lock held. """
+        if not self._corked and self._use_sendmsg and len(buffers) <= _MAX_SENDMSG_BUFFERS:
+            self._sendmsg(buffers)
+            return
+
+        frame = self._frame
+        end = self._pending
+        for data in buffers:
+            start = end
+            end += len(data)
+            frame[start:end] = data
+
+        if not self._corked:
+            self._send_frame(end)
+            return
+
+        if self._pending == 0 and self.flush_budget > 0:
+            self._flush_timer = threading.Timer(self.flush_budget / 1000000.0, self._flush_budget_expired)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+        self._pending = end
+
+    def _send_frame(self, end):
+        """ Send the first end bytes of the frame buffer. """
+        if self.sock is not None:
+            self.sock.sendall(memoryview(self._frame)[:end])
+        else:
+            self.stream.write(bytes(self._frame[:end]))
+
+    def _sendmsg(self, buffers):
+        """ Send buffers with socket.sendmsg, resending what a partial send left over. """
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
@@ -114,4 +114,5 @@ if __name__ == '__main__':
         log.info('Starting pinylib version: %s' % pinylib.__version__)
     else:
         log.addHandler(logging.NullHandler())
+    pinylib.open_api_store()
     main()
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Run the rooms of a room list on a number of worker processes.
+
+Every worker process hosts its share of the rooms with a room_manager.RoomManager.
+The supervisor restarts crashed (or hung) workers with a growing delay, collects
+the health reports the workers send over a pipe, and moves rooms from busy
+to idle workers by the message rate measured in each room.
+
+Usage: python supervisor.py [-p PROCESSES] [room_file]
+"""
+import argparse
+import logging
+import multiprocessing
+import signal
+import time
+
+import config
+import room_manager
+
+log = logging.getLogger(__name__)
+
+# the least seconds to wait before restarting a crashed worker.
+RESTART_DELAY = 1
+# a worker is restarted if it has not reported for this many health intervals.
+HEALTH_TIMEOUTS = 3
+# rooms are only moved if the busiest worker receives this much more (by ratio)
+# than the least busy worker.
+REBALANCE_RATIO = 0.25
+# the most rooms to move per rebalance.
+REBALANCE_MOVES = 4
+
+
+def read_room_list(file_path):
+    """ Read a room list file.
+
+    Every line holds a room name, optionally followed by the nick to use in the room.
+    Empty lines and lines starting with # are skipped.
+
+    :param file_path: The path to the room list file.
+    :type file_path: str
+    :return: A list of (room_name, nick) tuples.
+    :rtype: list
+    """
+    rooms = []
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            nick = parts[1].strip() if len(parts) == 2 else ''
+            rooms.append((parts[0], nick))
+    return rooms
+
+
+def _worker_main(conn, rooms, health_interval):
+    """ The main function of a worker process.
+
+    :param conn: The worker end of the pipe to the supervisor.
+    :type conn: multiprocessing.Connection
+    :param rooms: The (room_name, nick) tuples to join.
+    :type rooms: list
+    :param health_interval: Seconds between health reports.
+    :type health_interval: int | float
+    """
+    # the supervisor stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    manager = room_manager.RoomManager()
+    manager.start()
+    for room_name, nick in rooms:
+        manager.add_room(room_name, nick=nick, account=config.ACCOUNT, password=config.PASSWORD)
+
+    next_health = 0
+    try:
+        while True:
+            if conn.poll(max(0, next_health - time.time())):
+                cmd = conn.recv()
+                if cmd[0] == 'add':
+                    manager.add_room(cmd[1], nick=cmd[2], account=config.ACCOUNT, password=config.PASSWORD)
+                elif cmd[0] == 'remove':
+                    manager.remove_room(cmd[1])
+                elif cmd[0] == 'stop':
+                    break
+            if time.time() >= next_health:
+                conn.send(('health', {
+                    'time': time.time(),
+                    'stats': manager.stats(),
+                    'room_messages': manager.room_messages()
+                }))
+                next_health = time.time() + health_interval
+    except (EOFError, IOError):
+        # the supervisor is gone.
+        pass
+    finally:
+        manager.stop()
+
+
+class Worker(object):
+    """ A worker process, and the rooms it hosts. """
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        # nick keyed by room name.
+        self.rooms = {}
+        self.restarts = 0
+        self.restart_delay = RESTART_DELAY
+        # the time to restart the worker at, None while it is running.
+        self.restart_at = None
+        self.started = None
+        # the last health report, and the time it was received.
+        self.health = None
+        self.last_health = None
+
+    @property
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def send(self, *cmd):
+        """ Send a command to the worker process. """
+        try:
+            self.conn.send(cmd)
+        except (EOFError, IOError) as e:
+            log.warning('worker %s: failed to send %s: %s' % (self.index, cmd[0], e))
+
+
+class Supervisor(object):
+    """ Shards rooms across worker processes and keeps the workers running. """
+    def __init__(self, rooms, processes=config.SUPERVISOR_PROCESSES,
+                 health_interval=config.SUPERVISOR_HEALTH_INTERVAL,
+                 rebalance_interval=config.SUPERVISOR_REBALANCE_INTERVAL,
+                 max_restart_delay=config.SUPERVISOR_MAX_RESTART_DELAY):
+        """ Create a supervisor.
+
+        :param rooms: The (room_name, nick) tuples to join.
+        :type rooms: list
+        :param processes: The number of worker processes, None for one per cpu.
+        :type processes: int | None
+        :param health_interval: Seconds between the health reports of the workers.
+        :type health_interval: int | float
+        :param rebalance_interval: Seconds between rebalancing rooms, 0 to never rebalance.
+        :type rebalance_interval: int | float
+        :param max_restart_delay: The most seconds to wait before restarting a crashed worker.
+        :type max_restart_delay: int | float
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.health_interval = health_interval
+        self.rebalance_interval = rebalance_interval
+        self.max_restart_delay = max_restart_delay
+        self.workers = [Worker(i) for i in range(max(1, processes))]
+        # messages per second, keyed by room name.
+        self.rates = {}
+        # the (worker index, time, message count) a room last reported.
+        self._counts = {}
+        self._running = False
+        self._next_rebalance = 0
+        for room_name, nick in rooms:
+            self._least_loaded().rooms[room_name] = nick
+
+    def _load(self, worker):
+        """ The messages per second of the rooms of a worker. """
+        return sum(self.rates.get(room_name, 0) for room_name in worker.rooms)
+
+    def _least_loaded(self):
+        return min(self.workers, key=lambda w: (self._load(w), len(w.rooms)))
+
+    def add_room(self, room_name, nick=''):
+        """ Join a room on the least loaded worker.
+
+        :return: False if the room was already added, else True.
+        :rtype: bool
+        """
+        for worker in self.workers:
+            if room_name in worker.rooms:
+                return False
+        worker = self._least_loaded()
+        worker.rooms[room_name] = nick
+        if worker.is_alive:
+            worker.send('add', room_name, nick)
+        return True
+
+    def remove_room(self, room_name):
+        """ Leave a room.
+
+        :return: True if the room was removed, False if it was not added.
+        :rtype: bool
+        """
+        for worker in self.workers:
+            if room_name in worker.rooms:
+                del worker.rooms[room_name]
+                self.rates.pop(room_name, None)
+                self._counts.pop(room_name, None)
+                if worker.is_alive:
+                    worker.send('remove', room_name)
+                return True
+        return False
+
+    def start(self):
+        """ Start the worker processes. """
+        self._running = True
+        self._next_rebalance = time.time() + self.rebalance_interval
+        for worker in self.workers:
+            self._start_worker(worker)
+
+    def stop(self, timeout=10):
+        """ Stop the worker processes.
+
+        :param timeout: Seconds to wait for the workers to leave their rooms before they are terminated.
+        :type timeout: int | float
+        """
+        self._running = False
+        for worker in self.workers:
+            if worker.is_alive:
+                worker.send('stop')
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(max(0, deadline - time.time()))
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join()
+                worker.process = None
+
+    def run(self):
+        """ Start the workers and supervise them until stop is called. """
+        self.start()
+        try:
+            while self._running:
+                self.check()
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def check(self):
+        """ Read the health reports, restart crashed and hung workers, and rebalance if it is time to. """
+        now = time.time()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self._start_worker(worker)
+                continue
+
+            try:
+                while worker.conn.poll():
+                    msg = worker.conn.recv()
+                    if msg[0] == 'health':
+                        self._on_health(worker, msg[1])
+            except (EOFError, IOError):
+                pass
+
+            if not worker.is_alive:
+                log.error('worker %s exited with code %s' % (worker.index, worker.process.exitcode))
+                self._schedule_restart(worker, now)
+            elif now - (worker.last_health or worker.started) > self.health_interval * HEALTH_TIMEOUTS:
+                log.error('worker %s has not reported for %ss, terminating it.' %
+                          (worker.index, int(now - (worker.last_health or worker.started))))
+                worker.process.terminate()
+                worker.process.join()
+                self._schedule_restart(worker, now)
+
+        if self.rebalance_interval and now >= self._next_rebalance:
+            self._next_rebalance = now + self.rebalance_interval
+            self.rebalance()
+
+    def rebalance(self):
+        """ Move rooms from the busiest to the least busy workers.
+
+        A room is only moved if it narrows the gap between the two, and only
+        if the gap is big enough to be worth reconnecting the room for.
+
+        :return: The number of rooms moved.
+        :rtype: int
+        """
+        workers = [w for w in self.workers if w.is_alive]
+        moves = 0
+        while len(workers) > 1 and moves < REBALANCE_MOVES:
+            busiest = max(workers, key=self._load)
+            idlest = min(workers, key=self._load)
+            gap = self._load(busiest) - self._load(idlest)
+            if gap <= 0 or gap < self._load(busiest) * REBALANCE_RATIO:
+                break
+            # moving a room with rate r leaves a gap of abs(gap - 2 * r), only move
+            # rooms that narrow it by REBALANCE_RATIO, so rooms do not bounce back and forth.
+            candidates = [r for r in busiest.rooms
+                          if abs(gap - 2 * self.rates.get(r, 0)) <= gap * (1 - REBALANCE_RATIO)]
+            if not candidates:
+                break
+            room_name = min(candidates, key=lambda r: abs(gap - 2 * self.rates[r]))
+            log.info('moving room %s (%.2f msg/s) from worker %s to worker %s' %
+                     (room_name, self.rates[room_name], busiest.index, idlest.index))
+            nick = busiest.rooms.pop(room_name)
+            busiest.send('remove', room_name)
+            idlest.rooms[room_name] = nick
+            idlest.send('add', room_name, nick)
+            self._counts.pop(room_name, None)
+            moves += 1
+        return moves
+
+    def health(self):
+        """ The health of the workers.
+
+        :return: A dict per worker, with the last stats the worker reported.
+        :rtype: list
+        """
+        health = []
+        for worker in self.workers:
+            health.append({
+                'worker': worker.index,
+                'pid': worker.process.pid if worker.process is not None else None,
+                'alive': worker.is_alive,
+                'restarts': worker.restarts,
+                'rooms': len(worker.rooms),
+                'messages_per_second': self._load(worker),
+                'last_health': worker.last_health,
+                'stats': worker.health['stats'] if worker.health is not None else None
+            })
+        return health
+
+    def _start_worker(self, worker):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        worker.process = multiprocessing.Process(
+            target=_worker_main, name='room-worker-%s' % worker.index,
+            args=(child_conn, sorted(worker.rooms.items()), self.health_interval))
+        worker.process.daemon = True
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.restart_at = None
+        worker.started = time.time()
+        worker.last_health = None
+        log.info('started worker %s (pid %s) with %s rooms' % (worker.index, worker.process.pid, len(worker.rooms)))
+
+    def _schedule_restart(self, worker, now):
+        if now - worker.started > self.max_restart_delay:
+            # it ran for a while, so this is not a crash loop.
+            worker.restart_delay = RESTART_DELAY
+        worker.restarts += 1
+        worker.restart_at = now + worker.restart_delay
+        log.info('restarting worker %s in %ss' % (worker.index, worker.restart_delay))
+        worker.restart_delay = min(worker.restart_delay * 2, self.max_restart_delay)
+        worker.conn.close()
+
+    def _on_health(self, worker, report):
+        worker.health = report
+        worker.last_health = time.time()
+        for room_name, messages in report['room_messages'].items():
+            previous = self._counts.get(room_name)
+            self._counts[room_name] = (worker.index, report['time'], messages)
+            if previous is None or previous[0] != worker.index or messages < previous[2]:
+                # a new connection, there is nothing to measure against yet.
+                continue
+            seconds = report['time'] - previous[1]
+            if seconds > 0:
+                rate = (messages - previous[2]) / float(seconds)
+                # smooth out bursts.
+                self.rates[room_name] = (self.rates.get(room_name, rate) + rate) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the rooms of a room list on a number of processes.')
+    parser.add_argument('room_file', nargs='?', default=config.SUPERVISOR_ROOM_FILE,
+                        help='a room name (and optionally a nick) per line')
+    parser.add_argument('-p', '--processes', type=int, default=config.SUPERVISOR_PROCESSES,
+                        help='the number of worker processes, default one per cpu')
+    args = parser.parse_args()
+
+    rooms = read_room_list(args.room_file)
+    if not rooms:
+        log.error('no rooms in %s' % args.room_file)
+        return
+    supervisor = Supervisor(rooms, processes=args.processes)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        log.info('stopping supervisor.')
+
+
+if __name__ == '__main__':
+    formater = '%(asctime)s : %(levelname)s : %(processName)s : %(name)s : %(message)s'
+    if config.DEBUG_TO_FILE:
+        logging.basicConfig(filename=config.DEBUG_FILE_NAME, level=config.DEBUG_LEVEL, format=formater)
+    else:
+        logging.basicConfig(level=logging.INFO, format=formater)
+    main()
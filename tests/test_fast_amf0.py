@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Differential tests of rtmplib.fast_amf0 against pyamf's amf0.Decoder.
+
+Every payload is decoded by both decoders, the results must be identical,
+types included.
+"""
+import datetime
+import random
+import unittest
+
+import pyamf
+import pyamf.util
+from pyamf import amf0
+
+from rtmplib import fast_amf0, reader
+
+
+def encode(elements):
+    """ AMF0 encode a list of elements the way a command body is encoded. """
+    stream = pyamf.util.BufferedByteStream()
+    encoder = amf0.Encoder(stream)
+    for element in elements:
+        encoder.writeElement(element)
+    return stream.getvalue()
+
+
+def decode(data, decoder_class):
+    """ Decode all elements of a body, like RtmpReader does. """
+    stream = reader.BodyStream(memoryview(bytearray(data)))
+    decoder = decoder_class(stream)
+    elements = []
+    while not stream.at_eof():
+        elements.append(decoder.readElement())
+    return elements
+
+
+def shape(value):
+    """ A comparable form of a decoded value, keeping the types. """
+    if isinstance(value, dict):
+        return type(value).__name__, sorted((type(k).__name__, k, shape(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return 'list', [shape(v) for v in value]
+    if isinstance(value, float) and value != value:
+        return 'nan',
+    return type(value).__name__, value
+
+
+def user_info(i):
+    return pyamf.ASObject({'nick': u'user%d' % i, 'id': i, 'account': u'', 'own': False, 'mod': False,
+                           'lf': False, 'gp': 0, 'bf': False, 'btype': u'', 'stype': 0, 'alevel': u''})
+
+
+# command payloads as tinychat sends them.
+COMMANDS = [
+    [u'joins', 0, None] + [user_info(i) for i in range(10)],
+    [u'join', 0, None, user_info(42)],
+    [u'privmsg', 0, None, u','.join([u'104', u'105']), u'#262626,en', u'someone'],
+    [u'nick', 0, None, u'old', u'new', 42],
+    [u'quit', 0, None, u'someone', 42],
+    [u'registered', 0, None, user_info(1)],
+    [u'topic', 0, None, u'中文 topic'],
+    [u'banlist', 0, None, u'nick', 7, u'other', 8],
+    [u'_result', 1, None, pyamf.ASObject({'level': u'status', 'code': u'NetConnection.Connect.Success',
+                                          'objectEncoding': 0})],
+    [u'onStatus', 0, None, pyamf.MixedArray({'1': u'a', 'b': 2.5})],
+]
+
+# types the fast decoder hands to pyamf.
+FALLBACK = [
+    [u'cmd', 0, None, [1, u'two', None]],
+    [u'cmd', 0, None, datetime.datetime(2017, 1, 2, 3, 4, 5)],
+    [u'cmd', 0, None, u'x' * 70000],
+    [u'cmd', 0, None, pyamf.ASObject({'list': [1, 2], 'date': datetime.datetime(2017, 1, 2)})],
+]
+
+
+def random_string(rnd):
+    return u''.join(rnd.choice(u'abc\xe9中, 1') for _ in range(rnd.randint(0, 12)))
+
+
+def random_element(rnd, depth=0):
+    choice = rnd.randint(0, 11 if depth < 3 else 6)
+    if choice == 0:
+        return rnd.choice([0, 1, -5, 2 ** 31, 1.5, float('inf'), -0.0, 3.0, 1e300, float('nan')])
+    if choice == 1:
+        return rnd.choice([True, False])
+    if choice in (2, 5):
+        return random_string(rnd)
+    if choice == 3:
+        return None
+    if choice == 4:
+        return pyamf.Undefined
+    if choice == 6:
+        return rnd.randint(-1000, 1000)
+    if choice in (7, 8):
+        return pyamf.ASObject(dict(('%dk' % rnd.randint(0, 9), random_element(rnd, depth + 1))
+                                   for _ in range(rnd.randint(0, 4))))
+    if choice == 9:
+        array = pyamf.MixedArray()
+        for _ in range(rnd.randint(0, 4)):
+            array[rnd.choice(['1', '02', 'a', '7', 'x y'])] = random_element(rnd, depth + 1)
+        return array
+    if choice == 10:
+        return [random_element(rnd, depth + 1) for _ in range(rnd.randint(0, 3))]
+    return datetime.datetime(2017, 1, 2, 3, 4, 5)
+
+
+class TestFastAmf0(unittest.TestCase):
+
+    def assertSameDecode(self, elements):
+        data = encode(elements)
+        expected = decode(data, amf0.Decoder)
+        self.assertEqual(shape(decode(data, fast_amf0.Decoder)), shape(expected))
+
+    def test_commands(self):
+        for command in COMMANDS:
+            self.assertSameDecode(command)
+
+    def test_fallback(self):
+        for command in FALLBACK:
+            self.assertSameDecode(command)
+
+    def test_random_corpus(self):
+        rnd = random.Random(7)
+        for _ in range(5000):
+            self.assertSameDecode([random_element(rnd) for _ in range(rnd.randint(1, 6))])
+
+    def test_types(self):
+        elements = decode(encode([u'x', 1.0, 1.5, True, None, pyamf.Undefined]), fast_amf0.Decoder)
+        self.assertEqual([type(e) for e in elements], [unicode, int, float, bool, type(None), pyamf.UndefinedType])
+
+    def test_truncated(self):
+        data = encode([u'privmsg', 0, None, u'message'])[:-3]
+        self.assertRaises(IOError, decode, data, amf0.Decoder)
+        self.assertRaises(IOError, decode, data, fast_amf0.Decoder)
+
+
+if __name__ == '__main__':
+    unittest.main()
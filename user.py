@@ -1,6 +1,28 @@
+import threading
 import time
 
 
+def _id_key(user_id):
+    """ The id index key of a user id, so int, float and str ids of a user are equal.
+
+    :param user_id: The user id.
+    :type user_id: int | float | str
+    :return: The id as int, or as given if it is not a number.
+    :rtype: int | str
+    """
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        try:
+            return int(float(user_id))
+        except (TypeError, ValueError):
+            return user_id
+
+
+# The attributes deciding the roles of a user, see Users.
+_ROLE_ATTRIBUTES = frozenset(('is_mod', 'lf', 'account'))
+
+
 class User:
     """ class representing a users information. """
     def __init__(self, **kwargs):
@@ -23,6 +45,77 @@ class User:
         # Extras.
         self.last_msg = None
 
+    def __setattr__(self, name, value):
+        old_value = self.__dict__.get(name)
+        self.__dict__[name] = value
+        # keep the role views and the id index of the users the user belongs to up to date.
+        users = self.__dict__.get('_room_users')
+        if users is not None:
+            if name in _ROLE_ATTRIBUTES:
+                users._update_roles(self)
+            elif name == 'id':
+                users._update_id(self, old_value)
+
+
+class RoleView:
+    """
+    The users with a role, kept up to date by Users.
+
+    Counting (len) and checking (in, bool) is O(1). The users are kept in a
+    dict that is replaced, never changed, when a user gets or loses the role,
+    so iterating needs no copy and is not disturbed by users joining and
+    leaving meanwhile.
+    """
+    def __init__(self, has_role):
+        """
+        :param has_role: Takes a User, returns True if the user has the role.
+        :type has_role: callable
+        """
+        self.has_role = has_role
+        # User keyed by id(User).
+        self._users = dict()
+        # held while a new dict is made.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def __nonzero__(self):
+        return len(self._users) > 0
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        users = self._users
+        if hasattr(users, 'itervalues'):
+            return users.itervalues()
+        return iter(users.values())
+
+    def __contains__(self, _user):
+        return id(_user) in self._users
+
+    def update(self, _user):
+        """ Add the user if the user has the role, else remove the user. """
+        if not self.has_role(_user):
+            self.remove(_user)
+            return
+        with self._lock:
+            if self._users.get(id(_user)) is not _user:
+                users = dict(self._users)
+                users[id(_user)] = _user
+                self._users = users
+
+    def remove(self, _user):
+        with self._lock:
+            if id(_user) in self._users:
+                users = dict(self._users)
+                del users[id(_user)]
+                self._users = users
+
+    def clear(self):
+        with self._lock:
+            self._users = dict()
+
 
 class Users:
     """
@@ -34,6 +127,13 @@ class Users:
     def __init__(self):
         # Create a dictionary to store each user key value in.
         self._users = dict()
+        # The same users keyed by id, see _id_key.
+        self._ids = dict()
+        self._mods = RoleView(lambda u: u.is_mod)
+        self._signed_in = RoleView(lambda u: bool(u.account))
+        self._lurkers = RoleView(lambda u: bool(u.lf))
+        self._norms = RoleView(lambda u: not u.is_mod and not u.lf)
+        self._roles = (self._mods, self._signed_in, self._lurkers, self._norms)
 
     @property
     def all(self):
@@ -48,58 +148,47 @@ class Users:
     def mods(self):
         """ All the moderators in the room.
 
-        :return: A list of all of the moderators User objects in the room.
-        :rtype: list
+        :return: A view of all the moderator User objects in the room.
+        :rtype: RoleView
         """
-        _mods = []
-        for user in self.all:
-            if self.all[user].is_mod:
-                _mods.append(self.all[user])
-        return _mods
+        return self._mods
 
     @property
     def signed_in(self):
         """ All user in the room using an account.
 
-        :return: A list of all the signed in User objects in the room.
-        :rtype: list
+        :return: A view of all the signed in User objects in the room.
+        :rtype: RoleView
         """
-        _signed_ins = []
-        for user in self.all:
-            if self.all[user].account:
-                _signed_ins.append(self.all[user])
-        return _signed_ins
+        return self._signed_in
 
     @property
     def lurkers(self):
         """ All the lurkers in the room.
 
-        :return: A list of all the lurker User objects in the room.
-        :rtype: list
+        :return: A view of all the lurker User objects in the room.
+        :rtype: RoleView
         """
-        _lurkers = []
-        for user in self.all:
-            if self.all[user].lf:
-                _lurkers.append(self.all[user])
-        return _lurkers
+        return self._lurkers
 
     @property
     def norms(self):
         """ All the normal users in the room.
 
         e.g users that are not moderators or lurkers.
-        :return: A list of all the normal User objects in the room.
-        :rtype: list
+        :return: A view of all the normal User objects in the room.
+        :rtype: RoleView
         """
-        _regs = []
-        for user in self.all:
-            if not self.all[user].is_mod and not self.all[user].lf:
-                _regs.append(self.all[user])
-        return _regs
+        return self._norms
 
     def clear(self):
         """ Delete all the users. """
+        for _user in self._users.values():
+            _user.__dict__['_room_users'] = None
         self._users.clear()
+        self._ids.clear()
+        for role in self._roles:
+            role.clear()
 
     def add(self, user_info):
         """ Add a user to the users dict.
@@ -110,7 +199,10 @@ class Users:
         :rtype: User
         """
         if user_info['nick'] not in self.all:
-            self._users[user_info['nick']] = User(**user_info)
+            _user = User(**user_info)
+            self._users[user_info['nick']] = _user
+            self._ids[_id_key(_user.id)] = _user
+            self._attach(_user)
         return self.all[user_info['nick']]
 
     def change(self, old_nick, new_nick, user_info):
@@ -128,6 +220,8 @@ class Users:
         if self.delete(old_nick):
             if new_nick not in self.all:
                 self._users[new_nick] = user_info
+                self._ids[_id_key(user_info.id)] = user_info
+                self._attach(user_info)
                 return True
             return False
         return False
@@ -141,10 +235,32 @@ class Users:
         :rtype: bool
         """
         if user_name in self.all:
-            del self._users[user_name]
+            _user = self._users.pop(user_name)
+            id_key = _id_key(_user.id)
+            if self._ids.get(id_key) is _user:
+                del self._ids[id_key]
+            _user.__dict__['_room_users'] = None
+            for role in self._roles:
+                role.remove(_user)
             return True
         return False
 
+    def _attach(self, _user):
+        """ Make the role views follow the role attributes of a user. """
+        _user.__dict__['_room_users'] = self
+        self._update_roles(_user)
+
+    def _update_roles(self, _user):
+        for role in self._roles:
+            role.update(_user)
+
+    def _update_id(self, _user, old_id):
+        """ Move a user whose id was changed in the id index. """
+        old_key = _id_key(old_id)
+        if self._ids.get(old_key) is _user:
+            del self._ids[old_key]
+        self._ids[_id_key(_user.id)] = _user
+
     def search(self, user_name):
         """ Search the Users class by nick name for a user.
 
@@ -165,10 +281,7 @@ class Users:
         :return If user id is found, User else None
         :rtype: User | None
         """
-        for user in self.all:
-            if str(self.all[user].id) == user_id:
-                return self.all[user]
-        return None
+        return self._ids.get(_id_key(user_id))
 
     def search_containing(self, contains):
         """ Search users for a matching string within the user nick.
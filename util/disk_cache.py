@@ -0,0 +1,144 @@
+""" A key/value cache with expiry, kept in a sqlite database. """
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DiskCache(object):
+    """
+    Keeps values (anything json can encode) in a sqlite database until they expire.
+
+    The database is in WAL mode, so any number of threads and processes can read
+    it while one of them writes. Each thread uses its own connection. Expired
+    values are removed by compact, which start_compaction runs on a thread.
+    """
+    def __init__(self, path, timeout=5):
+        """
+        :param path: The path to the database file, the folder is created if needed.
+        :type path: str
+        :param timeout: Seconds to wait for a lock held by another process.
+        :type timeout: int | float
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._compaction = None
+        self._compaction_thread = None
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        db.commit()
+
+    def _db(self):
+        """ The connection of the current thread. """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            # WAL is safe against corruption with NORMAL, a crash may lose the last writes.
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        """ Get a value.
+
+        :param key: The key.
+        :type key: str
+        :return: (True, value, expires) if the key is stored and not expired, else (False, None, 0).
+        :rtype: tuple
+        """
+        try:
+            row = self._db().execute('SELECT value, expires FROM cache WHERE key = ? AND expires > ?',
+                                     (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            log.warning('disk cache read error: %s' % e)
+            return False, None, 0
+        if row is None:
+            return False, None, 0
+        return True, json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl):
+        """ Store a value.
+
+        :param key: The key.
+        :type key: str
+        :param value: The value.
+        :param ttl: Seconds until the value expires.
+        :type ttl: int | float
+        """
+        db = self._db()
+        try:
+            db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                       (key, json.dumps(value), time.time() + ttl))
+            db.commit()
+        except sqlite3.Error as e:
+            log.warning('disk cache write error: %s' % e)
+
+    def clear(self):
+        """ Remove all values. """
+        db = self._db()
+        try:
+            db.execute('DELETE FROM cache')
+            db.commit()
+        except sqlite3.Error as e:
+            log.warning('disk cache clear error: %s' % e)
+
+    def compact(self):
+        """ Remove the expired values, and move the write ahead log into the database.
+
+        :return: The number of values removed.
+        :rtype: int
+        """
+        db = self._db()
+        try:
+            removed = db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),)).rowcount
+            db.commit()
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            log.warning('disk cache compaction error: %s' % e)
+            return 0
+        log.debug('disk cache compacted, removed %s expired values.' % removed)
+        return removed
+
+    def start_compaction(self, interval):
+        """ Run compact every interval seconds on a thread.
+
+        :param interval: Seconds between compactions.
+        :type interval: int | float
+        """
+        if self._compaction is not None:
+            return
+        self._compaction = threading.Event()
+        # end the thread before the interpreter shuts down, it would fail on a half torn down interpreter.
+        atexit.register(self.stop_compaction, 1)
+        t = threading.Thread(target=self._compact_loop, args=(interval, self._compaction), name='disk-cache-compaction')
+        t.daemon = True
+        t.start()
+        self._compaction_thread = t
+
+    def stop_compaction(self, timeout=None):
+        """ Stop the compaction thread.
+
+        :param timeout: If given, wait up to timeout seconds for the thread to end.
+        :type timeout: int | float | None
+        """
+        if self._compaction is not None:
+            self._compaction.set()
+            self._compaction = None
+            if timeout is not None:
+                self._compaction_thread.join(timeout)
+            self._compaction_thread = None
+
+    def _compact_loop(self, interval, stopped):
+        while not stopped.wait(interval):
+            self.compact()
@@ -0,0 +1,216 @@
+""" A fixed size pool of worker threads. """
+import collections
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+log = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Runs tasks on a fixed number of threads.
+
+    Used instead of starting a thread per task, so the number of
+    threads stays the same no matter how many tasks there are.
+    """
+    def __init__(self, size=8, name='worker'):
+        """
+        :param size: The number of worker threads.
+        :type size: int
+        :param name: The thread name prefix.
+        :type name: str
+        """
+        self.size = size
+        self.name = name
+        self._tasks = queue.Queue()
+        self._threads = []
+        # the number of tasks completed, and the number of those that raised.
+        self.completed = 0
+        self.errors = 0
+
+    @property
+    def pending(self):
+        """ The number of tasks waiting for a worker. """
+        return self._tasks.qsize()
+
+    def start(self):
+        """ Start the worker threads. """
+        while len(self._threads) < self.size:
+            t = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self._threads)))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """ Stop the worker threads once the tasks submitted so far are done. """
+        for _ in self._threads:
+            self._tasks.put(None)
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """ Run a function on a worker thread.
+
+        :param func: The function to run.
+        """
+        self._tasks.put((func, args, kwargs))
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.errors += 1
+                log.error('worker task %s failed: %s' % (func, e), exc_info=True)
+            finally:
+                self.completed += 1
+
+
+class _Stripe(object):
+    """ The tasks waiting for one thread of a StripedPool. """
+    __slots__ = ('tasks', 'ready')
+
+    def __init__(self):
+        # (time submitted, func, args), or None to stop the thread.
+        self.tasks = collections.deque()
+        self.ready = threading.Condition(threading.Lock())
+
+
+class StripedPool(object):
+    """
+    Runs tasks on a fixed number of threads, each with its own queue.
+
+    Tasks with the same key always go to the same thread, so they run one at a
+    time, in the order they were submitted. submit never blocks and never drops
+    a task, the tasks may change state (a join adds a user) that later tasks
+    rely on. A queue holding more than max_size tasks is logged, and counted
+    as overflowed.
+    """
+    def __init__(self, size=4, max_size=100, name='striped'):
+        """
+        :param size: The number of worker threads.
+        :type size: int
+        :param max_size: The number of tasks waiting for a thread above which the queue is overflowed.
+        :type max_size: int
+        :param name: The thread name prefix.
+        :type name: str
+        """
+        self.size = max(1, size)
+        self.max_size = max_size
+        self.name = name
+        self._stripes = [_Stripe() for _ in range(self.size)]
+        self._threads = []
+        self._lock = threading.Lock()
+        # the number of tasks completed, those that raised and those queued above max_size.
+        self.completed = 0
+        self.errors = 0
+        self.overflowed = 0
+        self.max_pending = 0
+        # the total and the longest seconds tasks waited for a thread.
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def pending(self):
+        """ The number of tasks waiting for a thread. """
+        return sum(len(stripe.tasks) for stripe in self._stripes)
+
+    def start(self):
+        """ Start the worker threads. """
+        with self._lock:
+            if self._threads:
+                return
+            for i, stripe in enumerate(self._stripes):
+                t = threading.Thread(target=self._work, args=(stripe,), name='%s-%d' % (self.name, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def stop(self):
+        """ Stop the worker threads once the tasks submitted so far are done. """
+        with self._lock:
+            if not self._threads:
+                return
+            self._threads = []
+        for stripe in self._stripes:
+            self._put(stripe, None)
+
+    def submit(self, key, func, *args):
+        """ Run a function on the thread of a key. The threads are started if needed.
+
+        :param key: The key, tasks with equal keys run in order.
+        :type key: hashable
+        :param func: The function to run.
+        """
+        if not self._threads:
+            self.start()
+        depth = self._put(self._stripes[hash(key) % self.size], (time.time(), func, args))
+        if depth > self.max_size:
+            with self._lock:
+                self.overflowed += 1
+            if depth == self.max_size + 1:
+                log.warning('%s queue over %s tasks.' % (self.name, self.max_size))
+        pending = self.pending
+        if pending > self.max_pending:
+            self.max_pending = pending
+
+    def stats(self):
+        """ The queue depth, wait times and counters.
+
+        :rtype: dict
+        """
+        started = self.completed or 1
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'errors': self.errors,
+            'overflowed': self.overflowed,
+            'wait_avg_ms': self.wait / started * 1000,
+            'wait_max_ms': self.max_wait * 1000
+        }
+
+    @staticmethod
+    def _put(stripe, task):
+        """ Queue a task for the thread of a stripe.
+
+        :return: The number of tasks waiting for the thread.
+        :rtype: int
+        """
+        with stripe.ready:
+            stripe.tasks.append(task)
+            stripe.ready.notify()
+            return len(stripe.tasks)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            self.errors += 1
+            log.error('task %s failed: %s' % (func, e), exc_info=True)
+
+    def _work(self, stripe):
+        while True:
+            with stripe.ready:
+                while not stripe.tasks:
+                    stripe.ready.wait()
+                task = stripe.tasks.popleft()
+            if task is None:
+                return
+            put_time, func, args = task
+            wait = time.time() - put_time
+            self._run(func, args)
+            with self._lock:
+                self.completed += 1
+                self.wait += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
@@ -0,0 +1,107 @@
+""" A timer thread shared by many timed jobs. """
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    """ A scheduled call, returned by Scheduler.call_later. """
+    __slots__ = ('when', 'func', 'args', 'kwargs', 'cancelled')
+
+    def __init__(self, when, func, args, kwargs):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        """ Cancel the job, if it has not run yet. """
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Runs timed jobs on a single thread.
+
+    Used instead of a threading.Timer (a thread) per job. Jobs should be
+    quick, anything slow (web requests etc.) should be handed to a worker pool.
+    """
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self._jobs = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        # the number of jobs run, and the number of those that raised.
+        self.runs = 0
+        self.errors = 0
+
+    def __len__(self):
+        """ The number of pending jobs, including cancelled jobs not yet removed. """
+        return len(self._jobs)
+
+    def start(self):
+        """ Start the scheduler thread. """
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the scheduler thread. Pending jobs are dropped. """
+        with self._condition:
+            self._running = False
+            del self._jobs[:]
+            self._condition.notify()
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """ Call a function after a delay.
+
+        :param delay: The delay in seconds.
+        :type delay: int | float
+        :param func: The function to call.
+        :return: The job, which can be cancelled.
+        :rtype: Job
+        """
+        job = Job(time.time() + delay, func, args, kwargs)
+        with self._condition:
+            heapq.heappush(self._jobs, (job.when, next(self._counter), job))
+            # wake the thread if this is the next job.
+            if self._jobs[0][2] is job:
+                self._condition.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job = None
+                while self._running:
+                    if not self._jobs:
+                        self._condition.wait()
+                        continue
+                    delay = self._jobs[0][0] - time.time()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                    job = heapq.heappop(self._jobs)[2]
+                    if not job.cancelled:
+                        break
+                    job = None
+                if not self._running:
+                    return
+
+            self.runs += 1
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                self.errors += 1
+                log.error('scheduled job %s failed: %s' % (job.func, e), exc_info=True)
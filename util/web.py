@@ -2,6 +2,7 @@
 import time
 import logging
 import requests
+import requests.adapters
 from requests.utils import quote, unquote
 
 __all__ = ['quote', 'unquote']
@@ -13,6 +14,23 @@ log = logging.getLogger(__name__)
 __request_session = requests.session()
 
 
+def set_pool_size(pool_connections=10, pool_maxsize=10):
+    """
+    Set the size of the connection pool of the shared session.
+
+    All clients in a process share the session and its connection pool,
+    so a process hosting many rooms should use a pool that fits the
+    number of requests it makes at the same time.
+
+    :param pool_connections: int the number of hosts to keep pools for.
+    :param pool_maxsize: int the most connections to keep per host.
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    __request_session.mount('http://', adapter)
+    __request_session.mount('https://', adapter)
+    log.debug('http pool size: %s connections: %s' % (pool_maxsize, pool_connections))
+
+
 def is_cookie_expired(cookie_name):
     """
     Check if a cookie is expired.